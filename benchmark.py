@@ -0,0 +1,383 @@
+from telegram import Bot
+from peppybot import WebMonitoringBot
+from utility import Utility
+import multiprocessing
+import subprocess
+import argparse
+import tempfile
+import logging
+import asyncio
+import random
+import heapq
+import httpx
+import json
+import time
+import sys
+import os
+import re
+from urllib.parse import parse_qs
+
+
+class StandInServer:
+    # Token of the fake bot, any well-formed token is accepted by the stand-in Bot API
+    TOKEN = "123456:benchmark"
+
+    # Initialize the local stand-in of the monitored websites and of the Telegram Bot API
+    # A fraction of the pages changes on average every change_interval seconds, each reply is delayed by about latency seconds
+    # and a fraction of them fails with an internal server error
+    def __init__(self, pages, page_size, change_interval, changing, latency, failure_rate, etag):
+        self._pages = pages
+        self._change_interval = change_interval
+        self._changing = changing
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self._etag = etag
+        self._filler = self._make_filler(page_size)
+        self._versions = [0] * pages
+        self._changes_heap = []  # Heap of (time, page) of the next change of every changing page
+        self._pending = {}  # Map of page to the time of its first change not notified yet
+        self._latencies = []  # Time between a change and its first notification
+        self._requests = 0
+        self._changes = 0
+        self._messages = 0
+        self._server = None
+        self._ticker = None
+
+    def get_port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    # Private method to build the static part of the pages, so that each page is about page_size bytes
+    @staticmethod
+    def _make_filler(page_size) -> bytes:
+        lines = []
+        size = 0
+        while size < page_size:
+            line = f"<p>Paragraph {len(lines)} of a page served by the benchmark stand-in server.</p>\n"
+            lines.append(line)
+            size += len(line)
+        return "".join(lines).encode()
+
+    # Method to start listening on a local port
+    async def start(self, host, port=0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+
+    # Method to start changing the pages, resetting the statistics
+    def begin(self):
+        now = time.time()
+        self._changes_heap = [(now + random.expovariate(1 / self._change_interval), page)
+                              for page in random.sample(range(self._pages), int(self._pages * self._changing))]
+        heapq.heapify(self._changes_heap)
+        self._pending.clear()
+        self._latencies.clear()
+        self._requests = self._changes = self._messages = 0
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._change_pages())
+
+    # Method to return the statistics collected since the pages started changing
+    def get_stats(self) -> dict:
+        return {"requests": self._requests, "changes": self._changes, "messages": self._messages,
+                "latencies": self._latencies, "undetected": len(self._pending)}
+
+    # Private method changing the pages whose change is due
+    async def _change_pages(self):
+        while True:
+            now = time.time()
+            while self._changes_heap and self._changes_heap[0][0] <= now:
+                _, page = heapq.heappop(self._changes_heap)
+                self._versions[page] += 1
+                self._changes += 1
+                # The latency of a change is measured from the first change the users have not been told about
+                self._pending.setdefault(page, now)
+                heapq.heappush(self._changes_heap, (now + random.expovariate(1 / self._change_interval), page))
+            await asyncio.sleep(0.05)
+
+    # Private method serving the requests of a keep-alive connection
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := (await reader.readline()).strip()):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.decode("latin-1").split()[1]
+                if path.startswith("/page/"):
+                    status, response_headers, response = await self._page(int(path[len("/page/"):]), headers)
+                elif path.startswith("/bot"):
+                    status, response_headers, response = self._bot_api(path.rsplit("/", 1)[1], headers, body)
+                elif path == "/start":
+                    self.begin()
+                    status, response_headers, response = "200 OK", {}, b"{}"
+                elif path == "/stats":
+                    status, response_headers, response = "200 OK", {}, json.dumps(self.get_stats()).encode()
+                else:
+                    status, response_headers, response = "404 Not Found", {}, b""
+                head = f"HTTP/1.1 {status}\r\nContent-Length: {len(response)}\r\n"
+                head += "".join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+                writer.write(head.encode() + b"\r\n" + response)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, IndexError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # Private method serving a page, with its latency, failures and conditional requests
+    async def _page(self, page, headers) -> tuple:
+        self._requests += 1
+        if self._latency:
+            await asyncio.sleep(self._latency * random.uniform(0.5, 1.5))
+        if random.random() < self._failure_rate:
+            return "500 Internal Server Error", {}, b""
+        if not 0 <= page < self._pages:
+            return "404 Not Found", {}, b""
+        version = self._versions[page]
+        response_headers = {"Content-Type": "text/html; charset=utf-8"}
+        if self._etag:
+            etag = f'"{page}-{version}"'
+            if headers.get("if-none-match") == etag:
+                return "304 Not Modified", {"ETag": etag}, b""
+            response_headers["ETag"] = etag
+        body = f"<html><body><h1>Page {page}</h1>\n<p>Version {version}</p>\n".encode() + self._filler + b"</body></html>\n"
+        return "200 OK", response_headers, body
+
+    # Private method answering the Bot API methods used by the bot, recording when each change is notified
+    def _bot_api(self, method, headers, body) -> tuple:
+        if headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Peppy", "username": "peppy_benchmark_bot"}
+        elif method == "sendMessage":
+            self._messages += 1
+            now = time.time()
+            text = str(params.get("text", ""))
+            for page in re.findall(r"Content changed for \S+/page/(\d+)", text):
+                changed_at = self._pending.pop(int(page), None)
+                if changed_at is not None:
+                    self._latencies.append(now - changed_at)
+            result = {"message_id": self._messages, "date": int(now), "text": text,
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}}
+        else:
+            result = True
+        return "200 OK", {"Content-Type": "application/json"}, json.dumps({"ok": True, "result": result}).encode()
+
+
+# Entry point of the process running the stand-in server, which sends its port back through the pipe
+def run_stand_in(options, conn):
+    async def serve():
+        server = StandInServer(**options)
+        await server.start("127.0.0.1")
+        conn.send(server.get_port())
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+# Return the resident memory of the process in bytes, or None where it cannot be read
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Return the CPU time (in seconds) used so far by the process and by the fetch worker processes of the bot, if any
+def get_cpu(bot):
+    cpu = time.process_time()
+    if bot.get_shards() is not None:
+        for pid in bot.get_shards().get_worker_pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # The user and system times follow the state, 11 and 12 fields after the command name
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            except (OSError, ValueError, IndexError, AttributeError):
+                pass
+    return cpu
+
+
+# Return the q quantile (between 0 and 1) of a list of values
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+# Return the current commit of the repository, so that stored results can be traced back to the code
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkUtility(Utility):
+    # Initialize the utility of the bot under test, whose number of fetch processes is set by the command line instead of the .env file
+    def __init__(self, fetch_processes):
+        self._fetch_processes = fetch_processes
+
+    def load_fetch_processes(self) -> int:
+        return self._fetch_processes
+
+
+class BenchmarkBot(WebMonitoringBot):
+    # Environment variable holding the settings of the bot under test, so that the fetch worker processes build the same bot
+    SETTINGS_VARIABLE = "BENCHMARK_SETTINGS"
+
+    # Initialize the bot under test with the settings of the benchmark, which override the constants of the class
+    def __init__(self, database, shard=None):
+        settings = json.loads(os.environ[self.SETTINGS_VARIABLE])
+        self._benchmark_util = BenchmarkUtility(settings.pop("FETCH_PROCESSES"))
+        for name, value in settings.items():
+            setattr(self, name, value)
+        super().__init__(database, shard)
+
+    def get_utility(self):
+        return self._benchmark_util
+
+
+# Build the bot under test, polling at a fixed interval unless a maximum interval is given
+def build_bot(args, database) -> WebMonitoringBot:
+    # The environment variables are only needed to construct the bot, nothing is sent to Telegram
+    os.environ.setdefault("TOKEN_API", StandInServer.TOKEN)
+    os.environ.setdefault("STATE_REQUEST_URL", "0")
+    os.environ.setdefault("ALLOWED_IDS", "0")
+    settings = {"TIME": args.interval, "MIN_INTERVAL": args.interval, "MAX_INTERVAL": args.max_interval or args.interval,
+                "STARTUP_SPREAD": args.interval, "FETCH_WORKERS": args.fetch_workers, "FETCH_PROCESSES": args.fetch_processes,
+                # Every page is served by the same local host, which must not be limited like a real website
+                "MAX_CONNECTIONS_PER_HOST": WebMonitoringBot.MAX_CONNECTIONS}
+    # The settings are passed through the environment, which the fetch worker processes inherit
+    os.environ[BenchmarkBot.SETTINGS_VARIABLE] = json.dumps(settings)
+    return BenchmarkBot(database)
+
+
+# Save the users, monitors and subscriptions of the benchmark in a single transaction
+def populate(bot, args, port):
+    writes = [("insert_user", (1000 + user, f"user{user}")) for user in range(args.users)]
+    for page in range(args.pages):
+        url = f"http://127.0.0.1:{port}/page/{page}"
+        writes.append(("insert_monitor", (url, "")))  # The task is named when the monitor is restored
+        for k in range(args.subscribers):
+            writes.append(("insert_link", (1000 + (page + k) % args.users, url)))
+    bot.get_db().get_database().run_batch(writes)
+
+
+# Run the bot against the stand-in server and return the results
+async def run_benchmark(args, port, database) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    rss_before = get_rss()
+    bot = build_bot(args, database)
+    populate(bot, args, port)
+    telegram = Bot(StandInServer.TOKEN, base_url=f"{base_url}/bot")
+    await telegram.initialize()
+    await bot.start(telegram)
+    try:
+        # Warm up until every page has its baseline digest, so that the first checks are not counted
+        deadline = time.monotonic() + 3 * args.interval
+        while time.monotonic() < deadline and any(m.get_digest() is None for m in bot.get_registry().get_monitors()):
+            await asyncio.sleep(0.5)
+        rss_after = get_rss()
+        # With fetch worker processes, the fetches are counted by the workers
+        await bot.get_metrics().collect()
+        fetches = bot.get_metrics().get_fetches()
+        checks_before = fetches.total() - fetches.total(outcome="skipped")
+        errors_before = fetches.total(outcome="error")
+        cpu_before = get_cpu(bot)
+        async with httpx.AsyncClient() as client:
+            await client.get(f"{base_url}/start")
+            start = time.monotonic()
+            await asyncio.sleep(args.duration)
+            elapsed = time.monotonic() - start
+            stats = (await client.get(f"{base_url}/stats")).json()
+        cpu = get_cpu(bot) - cpu_before
+        await bot.get_metrics().collect()
+        checks = fetches.total() - fetches.total(outcome="skipped") - checks_before
+    finally:
+        await bot.cleanup()
+        await telegram.shutdown()
+    return {
+        "checks_per_second": checks / elapsed,
+        "cpu_per_check": cpu / checks if checks else None,
+        "detection_latency_p50": percentile(stats["latencies"], 0.5),
+        "detection_latency_p99": percentile(stats["latencies"], 0.99),
+        "memory_per_url": (rss_after - rss_before) / args.pages if rss_before is not None else None,
+        "changes": stats["changes"],
+        "detected": len(stats["latencies"]),
+        "undetected": stats["undetected"],
+        "errors": fetches.total(outcome="error") - errors_before,
+        "messages": stats["messages"],
+    }
+
+
+# Print the results next to those of the last stored run with the same parameters
+def report(results, previous):
+    for name, value in results.items():
+        line = f"{name:>24}: {value:.6g}" if isinstance(value, (int, float)) else f"{name:>24}: n/a"
+        old = previous.get(name) if previous else None
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"  (previous {old:.6g}, {(value - old) / old * 100:+.1f}%)"
+        print(line)
+
+
+# Return the results of the last run stored in the output file with the same parameters
+def load_previous(output, parameters):
+    previous = None
+    try:
+        with open(output) as f:
+            for line in f:
+                run = json.loads(line)
+                if run.get("parameters") == parameters:
+                    previous = run.get("results")
+    except (OSError, ValueError):
+        pass
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monitoring loop against a local stand-in of the websites and of the Telegram Bot API.")
+    parser.add_argument("--pages", type=int, default=2000, help="number of monitored pages")
+    parser.add_argument("--users", type=int, default=100, help="number of users")
+    parser.add_argument("--subscribers", type=int, default=1, help="number of users following each page")
+    parser.add_argument("--interval", type=float, default=10, help="interval between two checks of a page (seconds)")
+    parser.add_argument("--max-interval", type=float, default=None, help="let the interval of unchanged pages grow up to this value (seconds)")
+    parser.add_argument("--fetch-workers", type=int, default=WebMonitoringBot.FETCH_WORKERS, help="number of fetch workers")
+    parser.add_argument("--fetch-processes", type=int, default=0, help="number of fetch worker processes, 0 checks every page in the main process")
+    parser.add_argument("--duration", type=float, default=60, help="duration of the measurement (seconds)")
+    parser.add_argument("--page-size", type=int, default=20000, help="size of each page (bytes)")
+    parser.add_argument("--changing", type=float, default=0.2, help="fraction of the pages that change")
+    parser.add_argument("--change-interval", type=float, default=60, help="mean interval between two changes of a changing page (seconds)")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean latency of the pages (seconds)")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="fraction of the page requests failing with an error")
+    parser.add_argument("--no-etag", action="store_true", help="do not send ETags, so that every check downloads the whole page")
+    parser.add_argument("--output", default="benchmark.jsonl", help="file where the results are appended")
+    args = parser.parse_args()
+
+    # The stand-in server runs in its own process, so that its CPU and memory are not measured
+    conn, child_conn = multiprocessing.Pipe()
+    options = {"pages": args.pages, "page_size": args.page_size, "change_interval": args.change_interval, "changing": args.changing,
+               "latency": args.latency, "failure_rate": args.failure_rate, "etag": not args.no_etag}
+    stand_in = multiprocessing.get_context("spawn").Process(target=run_stand_in, args=(options, child_conn), daemon=True)
+    stand_in.start()
+    try:
+        port = conn.recv()
+        with tempfile.TemporaryDirectory() as directory:
+            results = asyncio.run(run_benchmark(args, port, os.path.join(directory, "benchmark.db")))
+    finally:
+        stand_in.terminate()
+
+    parameters = {name: value for name, value in vars(args).items() if name != "output"}
+    report(results, load_previous(args.output, parameters))
+    with open(args.output, "a") as f:
+        f.write(json.dumps({"timestamp": time.time(), "commit": get_commit(), "parameters": parameters, "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING, stream=sys.stderr)
+    main()
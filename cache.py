@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Initialize a cache keeping at most capacity entries, the least recently used entry is evicted first
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+
+    def get_capacity(self):
+        return self._capacity
+
+    # Method to return the number of cached entries
+    def count(self) -> int:
+        return len(self._entries)
+
+    # Method to retrieve the value of a key and mark it as recently used, or return default if the key is not cached
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    # Method to cache the value of a key, evicting the least recently used entry when the cache is full
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.get_capacity():
+            self._entries.popitem(last=False)
+
+    # Method to remove a key from the cache
+    def discard(self, key):
+        self._entries.pop(key, None)
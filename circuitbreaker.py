@@ -0,0 +1,109 @@
+import random
+import time
+
+
+class HostState:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    # Initialize the health of a host: consecutive failures and the state of its circuit
+    def __init__(self):
+        self._state = self.CLOSED
+        self._failures = 0  # Consecutive failed requests
+        self._opened = 0  # Consecutive times the circuit has been opened, driving the backoff
+        self._open_until = 0.0  # Monotonic time at which a probe request is allowed again
+        self._probing = False  # True while the probe request of a half-open circuit is in flight
+
+    def get_state(self):
+        return self._state
+
+    def get_failures(self):
+        return self._failures
+
+    def get_open_until(self):
+        return self._open_until
+
+
+class CircuitBreaker:
+    # Initialize the breaker: a host's circuit opens after threshold consecutive failures,
+    # and stays open for an exponential backoff (with jitter) between base_delay and max_delay seconds
+    # While the probe of a half-open circuit is in flight, the other requests to the host wait probe_wait seconds
+    def __init__(self, threshold, base_delay, max_delay, probe_wait):
+        self._threshold = threshold
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._probe_wait = probe_wait
+        self._hosts = {}  # Map of host to its HostState
+
+    def get_threshold(self):
+        return self._threshold
+
+    def get_base_delay(self):
+        return self._base_delay
+
+    def get_max_delay(self):
+        return self._max_delay
+
+    def get_probe_wait(self):
+        return self._probe_wait
+
+    # Private method to retrieve (or create) the state of a host
+    def _get_host_state(self, host) -> HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = HostState()
+            self._hosts[host] = state
+        return state
+
+    # Method to retrieve the state of the circuit of every host
+    def get_host_states(self) -> dict:
+        return dict(self._hosts)
+
+    # Method to check whether a request to a host may be sent
+    # Once the backoff of an open circuit has elapsed, a single probe request is let through (half-open)
+    def allow(self, host) -> bool:
+        state = self._hosts.get(host)
+        if state is None or state._state == HostState.CLOSED:
+            return True
+        if state._probing or time.monotonic() < state._open_until:
+            return False
+        state._state = HostState.HALF_OPEN
+        state._probing = True
+        return True
+
+    # Method to return the number of seconds before a request to a host is allowed again
+    # A request refused by allow() always gets a positive delay, so that it is seen as skipped rather than failed
+    def retry_after(self, host) -> float:
+        state = self._hosts.get(host)
+        if state is None or state._state == HostState.CLOSED:
+            return 0.0
+        if state._probing:
+            return self.get_probe_wait()
+        return max(state._open_until - time.monotonic(), 0.0)
+
+    # Method to record a successful request, closing the circuit of the host
+    def record_success(self, host):
+        # Forget the host entirely: a healthy host needs no state
+        self._hosts.pop(host, None)
+
+    # Method to record a failed request, opening the circuit of the host when needed
+    def record_failure(self, host):
+        state = self._get_host_state(host)
+        state._failures += 1
+        state._probing = False
+        if state._state == HostState.OPEN:
+            # A request sent before the circuit opened must not extend the backoff
+            return
+        if state._state == HostState.HALF_OPEN or state._failures >= self.get_threshold():
+            # Double the backoff every time the circuit opens again, with jitter so hosts do not recover in lockstep
+            delay = min(self.get_base_delay() * 2 ** state._opened, self.get_max_delay())
+            state._opened += 1
+            state._state = HostState.OPEN
+            state._open_until = time.monotonic() + delay * random.uniform(0.5, 1.5)
+
+    # Method to release the probe of a half-open circuit whose request ended without an outcome (e.g. cancelled)
+    def release(self, host):
+        state = self._hosts.get(host)
+        if state is not None:
+            state._probing = False
@@ -4,30 +4,95 @@ from httpx import RequestError, HTTPStatusError, AsyncClient, Response
 from urllib.parse import urlparse, urljoin
 from dotenv import load_dotenv
 from database import Database
+from sharding import ShardPool
+from utility import Utility
+from cache import LRUCache
 import validators
 import logging
 import asyncio
+import json
+import re
 import signal
 import sys
 import os
 
 
 class Command:
-    def __init__(self, database, max_tasks_for_user, state_request_url):
-        self._db = database
+    # Maximum number of masks of a URL and maximum length of a selector or mask
+    MAX_MASKS = 10
+    MAX_PATTERN_LENGTH = 200
+
+    def __init__(self, database, scheduler, registry, max_tasks_for_user, state_request_url, min_interval, max_interval, metrics, user_cache_size, quota, admin_ids):
         self._db = database
+        self._metrics = metrics
+        self._scheduler = scheduler
+        self._registry = registry
         self._max_tasks_for_user = max_tasks_for_user
+        self._quota = quota
+        self._admin_ids = admin_ids
         self._state_request_url = state_request_url
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        # Whether each recently active user is registered, kept up to date by start_command and stop_command
+        self._users = LRUCache(user_cache_size)
 
     def get_state_request_url(self):
         return self._state_request_url
 
     def get_max_tasks_per_user(self):
         return self._max_tasks_for_user
+
+    def get_quota(self):
+        return self._quota
+
+    def get_admin_ids(self):
+        return self._admin_ids
+
+    def get_min_interval(self):
+        return self._min_interval
+
+    def get_max_interval(self):
+        return self._max_interval
+
+    def get_metrics(self):
+        return self._metrics
     
     def get_db(self):
         return self._db
 
+    def get_scheduler(self):
+        return self._scheduler
+
+    def get_registry(self):
+        return self._registry
+
+    def get_users(self):
+        return self._users
+
+    # Check whether a user is registered, reading the database only for users missing from the cache
+    async def is_registered(self, uid) -> bool:
+        registered = self.get_users().get(uid)
+        if registered is None:
+            registered = await self.get_db().get_user(uid) is not None
+            self.get_users().put(uid, registered)
+        return registered
+
+    # Delete a monitor nobody follows anymore from the database, then remove its job from the scheduler,
+    # waiting for a check in progress to terminate
+    async def remove_monitor(self, monitor):
+        # The delete is submitted first, so it is executed before any later follow of the same URL
+        await self.get_db().delete_monitor(monitor.get_url())
+        if await self.get_scheduler().remove(monitor.get_task_name()):
+            logging.info(f"{monitor.get_task_name()} for {monitor.get_url()} removed from the scheduler.")
+
+    # Change the extraction pipeline of a monitor, in this process or in the fetch worker process checking it
+    async def configure_monitor(self, monitor, selector, masks):
+        # Invalid selectors and masks raise an error before anything is changed
+        monitor.set_pipeline(selector, masks)
+        if isinstance(self.get_scheduler(), ShardPool):
+            self.get_scheduler().configure(monitor.get_task_name(), selector, masks)
+        await self.get_db().set_monitor_pipeline(monitor.get_url(), selector, json.dumps(masks) if masks else None)
+
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Create a greeting message for the user when they start the bot
         text = f"Hello <b>{update.message.from_user.username}</b>, it's a pleasure to meet you! I am @PeppyWebMonitorBot.\n" \
@@ -36,7 +101,8 @@ class Command:
         # Send the greeting message to the user with HTML formatting
         await update.message.reply_text(f"{text}", parse_mode='HTML')
         # Insert the user into the database for tracking purposes
-        self.get_db().insert_user(update.message.from_user.id, update.message.from_user.username)
+        await self.get_db().insert_user(update.message.from_user.id, update.message.from_user.username)
+        self.get_users().put(update.message.from_user.id, True)
 
     @staticmethod
     async def show_help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -44,49 +110,184 @@ class Command:
         text = "\nHere is a list of available commands:\n" \
                "/start - restart the bot\n" \
                "/follow - follow a URL\n" \
+               "/feed - follow the pages listed by a sitemap or an RSS/Atom feed\n" \
                "/unfollow - unfollow a URL\n" \
                "/stop - stop tracking of all URLs\n" \
+               "/interval - set how often your URLs are checked\n" \
                "/cancel - cancel command\n" \
                "/list - display followed URLs\n" \
+               "/export - download followed URLs (CSV, or OPML with /export opml)\n" \
+               "/filter - choose the part of a page that is compared\n" \
                "/help - show this list of commands\n"
         # Send the help message to the user with HTML formatting
         await update.message.reply_text(f"Hi <b>{update.message.from_user.username}</b>, you are in /help command!\n{text}", parse_mode='HTML')
 
     async def stop_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        # Clear all tasks associated with the user when they stop monitoring URLs.
-        task_name_list = self.get_db().get_tasks(update.message.from_user.id)
-        tasks_to_cancel = [task for task in asyncio.all_tasks() if task.get_name() in task_name_list]
-
-        for task in tasks_to_cancel:
-            # Cancel each task that matches the user's tasks.
-            task.cancel()
-            await asyncio.sleep(0.3)
-            logging.info(f"{task.get_name()} requested cancellation.")
+        # Clear all subscriptions of the user when they stop monitoring URLs.
+        orphans = self.get_registry().unsubscribe_all(update.message.from_user.id)
+        # Stop the monitors nobody follows anymore concurrently.
+        await asyncio.gather(*[self.remove_monitor(monitor) for monitor in orphans])
         # Delete the user from the database after stopping monitoring.
-        self.get_db().delete_user(update.message.from_user.id)
+        await self.get_db().delete_user(update.message.from_user.id)
+        self.get_users().put(update.message.from_user.id, False)
         await update.message.reply_text("All monitoring has been stopped. You can reactivate me using /start.")
 
+    async def interval_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Set the bounds (in minutes) within which the polling interval of the user's URLs adapts to how often they change.
+        uid = update.message.from_user.id
+        lower, upper = self.get_min_interval() // 60, self.get_max_interval() // 60
+        if len(context.args) == 0:
+            user_min, user_max = self.get_registry().get_user_bounds(uid)
+            user_min = lower if user_min is None else int(user_min // 60)
+            user_max = upper if user_max is None else int(user_max // 60)
+            await update.message.reply_text(f"Your URLs are checked every {user_min} to {user_max} minutes, depending on how often they change.\n"
+                                            f"Use /interval <min> <max> to change it (between {lower} and {upper} minutes) or /interval reset.")
+            return
+        if len(context.args) == 1 and context.args[0] == "reset":
+            min_interval, max_interval = None, None
+        else:
+            try:
+                min_interval, max_interval = [int(arg) * 60 for arg in context.args]
+            except ValueError:
+                await update.message.reply_text("Please use /interval <min> <max> with the number of minutes.")
+                return
+            if min_interval > max_interval or min_interval < self.get_min_interval() or max_interval > self.get_max_interval():
+                await update.message.reply_text(f"The interval must be between {lower} and {upper} minutes.")
+                return
+        # Save the bounds of the user, which are applied from the next check of each of their URLs.
+        await self.get_db().set_user_bounds(uid, min_interval, max_interval)
+        self.get_registry().set_user_bounds(uid, min_interval, max_interval)
+        await update.message.reply_text("Your polling interval has been updated.")
+
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Show the metrics of the monitoring loop, only available to the administrators.
+        await self.get_metrics().collect()
+        await update.message.reply_text(self.get_metrics().summary())
+
+    async def workers_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Show or change the number of fetch worker processes, only available to the administrators.
+        pool = self.get_scheduler()
+        if not isinstance(pool, ShardPool):
+            await update.message.reply_text("Fetch worker processes are disabled, set FETCH_PROCESSES to enable them.")
+            return
+        if len(context.args) == 0:
+            counts = pool.get_shard_counts()
+            text = "\n".join(f"Worker {i + 1}: {count} URLs" for i, count in enumerate(counts))
+            await update.message.reply_text(f"{len(counts)} fetch worker processes.\n{text}\nUse /workers <number> to change it.")
+            return
+        try:
+            processes = int(context.args[0])
+        except ValueError:
+            processes = 0
+        if processes < 1:
+            await update.message.reply_text("Please use /workers <number> with a positive number of processes.")
+            return
+        # Only the URLs whose owner changes are moved, the others keep being checked by their worker.
+        moved = await pool.resize(processes)
+        await update.message.reply_text(f"{processes} fetch worker processes running, {moved} URLs moved.")
+
     async def show_list_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Retrieve and display all URLs currently being followed by the user.
-        urls = self.get_db().get_links(update.message.from_user.id)
+        uid = update.message.from_user.id
+        urls = self.get_registry().get_links(uid)
         if urls is not None and len(urls) > 0:
             text = ""
             for i, item in enumerate(urls):
-                text += f"{i + 1}. {item}\n"
+                # Show the share of the hourly cost of each URL paid by the user.
+                share = len(self.get_registry().get_subscribers(item))
+                monitor = self.get_registry().get_monitor(item)
+                requests, size, _ = (cost / share for cost in monitor.get_hourly_cost())
+                kind = "feed, " if monitor.is_feed() else ""
+                text += f"{i + 1}. {item} ({kind}{requests:.0f} requests, {Utility.format_size(size)} per hour)\n"
+            requests, size, cpu = self.get_registry().get_usage(uid)
+            max_requests, max_size, max_cpu = self.get_quota().get_budget()
+            text += f"\nFetch budget used per hour: {requests:.0f}/{max_requests} requests, {Utility.format_size(size)}/{Utility.format_size(max_size)}, " \
+                    f"{cpu:.1f}/{max_cpu:.0f} s of CPU."
+            if self.get_quota().get_throttle(uid) > 1.0:
+                text += " You are over budget: your URLs are checked less often."
             await update.message.reply_text(text, disable_web_page_preview=True)
         else:
             await update.message.reply_text("You are not currently following any URLs.")
 
+    async def filter_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Choose the part of a page compared between two checks: a CSS selector or XPath region, and masks hiding volatile tokens.
+        urls = self.get_registry().get_links(update.message.from_user.id)
+        usage = "Use /filter <number or URL> region <CSS selector or XPath>, /filter <number or URL> mask <regular expression> " \
+                "or /filter <number or URL> reset. Numbers are those shown by /list."
+        if len(context.args) == 0:
+            await update.message.reply_text(usage)
+            return
+        target = context.args[0]
+        if target.isdigit() and 1 <= int(target) <= len(urls):
+            url = urls[int(target) - 1]
+        else:
+            # A feed URL keeps its query, a page URL does not
+            url = Utility.normalize_url(target, keep_query=True)
+            if url not in urls:
+                url = Utility.normalize_url(target)
+        monitor = self.get_registry().get_monitor(url)
+        if url not in urls or monitor is None:
+            await update.message.reply_text("You are not following this URL. " + usage)
+            return
+        if len(context.args) == 1:
+            masks = "\n".join(f"- {mask}" for mask in monitor.get_masks())
+            await update.message.reply_text(f"Region: {monitor.get_selector() or 'whole page'}\nMasks:\n{masks or 'none'}", disable_web_page_preview=True)
+            return
+        # The monitor is shared, so only an admin or the only user following the URL can change what every subscriber is notified of.
+        uid = update.message.from_user.id
+        if uid not in self.get_admin_ids() and self.get_registry().get_subscribers(url) != [uid]:
+            await update.message.reply_text("Other users follow this URL too, only an admin can change its filter.")
+            return
+        action = context.args[1].lower()
+        pattern = " ".join(context.args[2:])
+        if action == "reset":
+            selector, masks = None, []
+        elif action in ("region", "mask") and 0 < len(pattern) <= self.MAX_PATTERN_LENGTH:
+            selector, masks = monitor.get_selector(), list(monitor.get_masks())
+            if action == "region":
+                selector = pattern
+            elif len(masks) >= self.MAX_MASKS:
+                await update.message.reply_text(f"A URL can have at most {self.MAX_MASKS} masks.")
+                return
+            else:
+                masks.append(pattern)
+        else:
+            await update.message.reply_text(usage)
+            return
+        try:
+            await self.configure_monitor(monitor, selector, masks)
+        except (ValueError, re.error) as e:
+            await update.message.reply_text(f"Invalid {action}: {e}")
+            return
+        # The monitor is shared, so the pipeline applies to every user following the URL.
+        await update.message.reply_text(f"The filter of {url} has been updated for everyone following it, the next check sets a new reference.",
+                                        disable_web_page_preview=True)
+
+    async def export_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Send the URLs followed by the user as a CSV file, or as an OPML file with /export opml.
+        urls = self.get_registry().get_links(update.message.from_user.id)
+        if urls is None or len(urls) <= 0:
+            await update.message.reply_text("You are not currently following any URLs.")
+            return
+        if len(context.args) > 0 and context.args[0].lower() == "opml":
+            await update.message.reply_document(document=Utility.export_opml(urls), filename="subscriptions.opml")
+        else:
+            await update.message.reply_document(document=Utility.export_csv(urls), filename="subscriptions.csv")
+
     async def follow_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # Check if user exists in database; if not call start_command.
-        if self.get_db().get_user(update.message.from_user.id) is None:
+        if not await self.is_registered(update.message.from_user.id):
             await self.start_command(update, context)
 
-        if self.get_db().get_count_links(update.message.from_user.id) >= self.get_max_tasks_per_user():
+        if self.get_registry().count_links(update.message.from_user.id) >= self.get_max_tasks_per_user():
             await update.message.reply_text("You have reached the maximum number of URLs being tracked.")
             return ConversationHandler.END
 
-        await update.message.reply_text("Please enter the URL you wish to follow:")
+        if self.get_quota().get_load(self.get_registry().get_usage(update.message.from_user.id)) >= 1.0:
+            await update.message.reply_text("You have used your whole fetch budget. Use /list to see your usage, or /unfollow URLs to free some of it.")
+            return ConversationHandler.END
+
+        await update.message.reply_text("Please enter the URL you wish to follow, paste several URLs at once or send a CSV or OPML file:")
         # Return to this state to wait for a valid URL input.
         return self.get_state_request_url()
 
@@ -101,26 +302,22 @@ class Command:
     async def unfollow_callback(self, update: Update, context: CallbackContext) -> None:
         curr_option: str = update.callback_query.data
         logging.info(f"current_option: {curr_option}")
-        curr_task = self.get_db().get_task(update.effective_user.id, curr_option)
-        for task in asyncio.all_tasks():
-            if task.get_name() == curr_task:
-                # Cancel and delete the selected task.
-                task.cancel()
-                logging.info(f"{task.get_name()} requested cancellation...")
-                # Wait for the task deletion to be completed.
-                await asyncio.sleep(0.3)
-                logging.info(f"Task for {curr_option} has been terminated: {True if task.done() else False}!")
-                logging.info(f"Attempting to delete message for user {update.effective_user.id}")
-                try:
-                    await update.callback_query.delete_message()
-                    logging.info(f"Message deleted successfully for user {update.effective_user.id}")
-                except Exception as e:
-                    logging.error(f"Error deleting message: {e} for user {update.effective_user.id}")
-        # Delete link from database after unfollowing.
-        self.get_db().delete_link(update.effective_user.id, curr_option)
+        if self.get_registry().is_subscribed(update.effective_user.id, curr_option):
+            orphan = self.get_registry().unsubscribe(update.effective_user.id, curr_option)
+            # Delete link from database after unfollowing.
+            await self.get_db().delete_link(update.effective_user.id, curr_option)
+            if orphan is not None:
+                await self.remove_monitor(orphan)
+            logging.info(f"Attempting to delete message for user {update.effective_user.id}")
+            try:
+                await update.callback_query.delete_message()
+                logging.info(f"Message deleted successfully for user {update.effective_user.id}")
+            except Exception as e:
+                logging.error(f"Error deleting message: {e} for user {update.effective_user.id}")
+            await update.effective_chat.send_message(f"Monitoring of {curr_option} stopped.")
 
     async def unfollow_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        urls = self.get_db().get_links(update.message.from_user.id)
+        urls = self.get_registry().get_links(update.message.from_user.id)
         if urls is None or len(urls) <= 0:
             await update.message.reply_text("You are not following any URLs.")
         else:
@@ -1,14 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import sqlite3
 import logging
+import asyncio
+import time
 
 
 class Database:
     # Initialize the database connection and create necessary tables
     def __init__(self, db_name):
-        self._conn = sqlite3.connect(db_name)  # Connect to the SQLite database
+        # Connect to the SQLite database, the connection is then used only by the AsyncDatabase thread
+        self._conn = sqlite3.connect(db_name, check_same_thread=False)
         self._cursor = self._conn.cursor()  # Create a cursor object to interact with the database
         # Active support for foreign keys
         self._cursor.execute("PRAGMA foreign_keys = ON;")
+        # Use write-ahead logging so that reads are not blocked by writes and commits need fewer fsyncs
+        self._cursor.execute("PRAGMA journal_mode = WAL;")
+        self._cursor.execute("PRAGMA synchronous = NORMAL;")
+        self._batch = False  # True while a batch of writes is executed in a single transaction
         self._create_tables()  # Call method to create tables
 
     # Destructor to ensure cleanup when the object is deleted
@@ -17,7 +26,7 @@ class Database:
 
     # Private method to close the database connection and cursor
     def _close(self):
-        self.delete_table()  # Delete all tables before closing
+        # Tables are kept so that subscriptions and monitor state survive a restart
         if self.get_cursor():
             self._cursor.close()  # Close cursor and connection
             logging.info("Database cursor closed.")  # Log that the cursor has been closed
@@ -31,13 +40,32 @@ class Database:
     def get_cursor(self):
         return self._cursor
 
+    # Private method to commit the current transaction, unless a batch of writes is being executed
+    def _commit(self):
+        if not self._batch:
+            self.get_conn().commit()
+
+    # Method to execute many writes in a single transaction, each write is a (method name, arguments) pair
+    def run_batch(self, writes):
+        self._batch = True
+        try:
+            for name, args in writes:
+                try:
+                    getattr(self, name)(*args)
+                except sqlite3.Error as e:
+                    # A failing write must not discard the rest of the batch
+                    logging.error(f"Error in batched {name}: {e}")
+        finally:
+            self._batch = False
+        self.get_conn().commit()  # Commit all the writes of the batch at once
+
     # Method to delete all tables in the database
     def delete_table(self):
         conn = self.get_conn()
         cursor = self.get_cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")  # Get all table names
         tables = cursor.fetchall()  # Fetch all table names
-        for table in tables:
+        for table in reversed(tables):  # Drop referencing tables before the tables they reference
             table_name = table[0]
             if table_name.isidentifier():
                 cursor.execute(f"DROP TABLE IF EXISTS {table_name}")  # Drop each table if it exists
@@ -52,80 +80,154 @@ class Database:
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS user(
             userid INT PRIMARY KEY,
-            username VARCHAR(15) NOT NULL UNIQUE
+            username VARCHAR(15) NOT NULL UNIQUE,
+            min_interval REAL,
+            max_interval REAL
             );
         """)  # SQL command to create user table
         conn.commit()  # Commit changes to the database
 
-    # Private method to create the link table if it doesn't exist
-    def _create_link_table_if_not_exists(self):
+    # Private method to create the monitor table if it doesn't exist
+    def _create_monitor_table_if_not_exists(self):
         conn = self.get_conn()
         cursor = self.get_cursor()
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS link(
+        CREATE TABLE IF NOT EXISTS monitor(
             url TEXT PRIMARY KEY,
-            userid INT,
             taskid TEXT NOT NULL,
-            FOREIGN KEY (userid) REFERENCES user(userid) ON DELETE CASCADE
+            etag TEXT,
+            last_modified TEXT,
+            digest TEXT,
+            length INT NOT NULL DEFAULT 0,
+            next_check REAL NOT NULL DEFAULT 0,
+            interval REAL,
+            checks INT NOT NULL DEFAULT 0,
+            changes INT NOT NULL DEFAULT 0,
+            last_change REAL,
+            selector TEXT,
+            masks TEXT,
+            fetch_bytes REAL,
+            fetch_cpu REAL,
+            kind TEXT
+            );
+        """)  # SQL command to create monitor table, one row for each unique URL being checked
+        conn.commit()  # Commit changes to the database
+
+    # Private method to create the subscription table if it doesn't exist
+    def _create_subscription_table_if_not_exists(self):
+        conn = self.get_conn()
+        cursor = self.get_cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscription(
+            userid INT,
+            url TEXT,
+            PRIMARY KEY (userid, url),
+            FOREIGN KEY (userid) REFERENCES user(userid) ON DELETE CASCADE,
+            FOREIGN KEY (url) REFERENCES monitor(url) ON DELETE CASCADE
+            );
+        """)  # SQL command to create subscription table linking users to the monitored URLs
+        conn.commit()  # Commit changes to the database
+
+    # Private method to add a column to a table created by an earlier version of the bot, returning True if it was added
+    def _add_column_if_not_exists(self, table, column, definition) -> bool:
+        cursor = self.get_cursor()
+        cursor.execute(f"PRAGMA table_info({table});")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+            logging.info(f"Column {column} added to table {table}.")
+            return True
+        return False
+
+    # Private method to bring the user table of a database created by the baseline bot up to date,
+    # the other tables did not exist before and are created with all their columns
+    def _upgrade_tables(self):
+        self._add_column_if_not_exists("user", "min_interval", "REAL")
+        self._add_column_if_not_exists("user", "max_interval", "REAL")
+        self.get_conn().commit()  # Commit changes to the database
+
+    # Private method to create the snapshot tables if they don't exist
+    def _create_snapshot_tables_if_not_exist(self):
+        conn = self.get_conn()
+        cursor = self.get_cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blob(
+            digest TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INT NOT NULL
+            );
+        """)  # SQL command to create blob table, holding each distinct compressed body once
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            taken_at REAL NOT NULL,
+            FOREIGN KEY (url) REFERENCES monitor(url) ON DELETE CASCADE
             );
-        """)  # SQL command to create link table with foreign key reference to user table
+        """)  # SQL command to create snapshot table, recording when each body of a URL was seen
         conn.commit()  # Commit changes to the database
 
-    # Method to create both user and link tables by calling private methods
+    # Private method to create the indexes used by the most frequent queries if they don't exist
+    def _create_indexes_if_not_exist(self):
+        conn = self.get_conn()
+        cursor = self.get_cursor()
+        # Lookups by user are served by the (userid, url) primary key, lookups of the subscribers of a URL need their own index
+        cursor.execute("CREATE INDEX IF NOT EXISTS subscription_url ON subscription(url);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS monitor_next_check ON monitor(next_check);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS snapshot_url ON snapshot(url, taken_at);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS snapshot_digest ON snapshot(digest);")
+        conn.commit()  # Commit changes to the database
+
+    # Method to create the user, monitor, subscription and snapshot tables by calling private methods
     def _create_tables(self):
         self._create_user_table_if_not_exists()  # Create user table
-        self._create_link_table_if_not_exists()  # Create link table
+        self._create_monitor_table_if_not_exists()  # Create monitor table
+        self._create_subscription_table_if_not_exists()  # Create subscription table
+        self._create_snapshot_tables_if_not_exist()  # Create blob and snapshot tables
+        self._upgrade_tables()  # Add the columns missing from tables created by earlier versions
+        self._create_indexes_if_not_exist()  # Create indexes
 
     # Method to insert a new user into the user table, ignoring duplicates
     def insert_user(self, uid, usrn):
         if not usrn or len(usrn) > 15:
             raise ValueError("The user name must be non-empty and less than 15 characters.")
         else:
-            conn = self.get_conn()
             cursor = self.get_cursor()
             cursor.execute("""
                 INSERT OR IGNORE INTO user (userid, username) VALUES (?, ?)
             """, (uid, usrn))  # Insert user data into the user table if it doesn't already exist
-            conn.commit()  # Commit changes to the database
+            self._commit()  # Commit changes to the database
 
     # Method to count how many links a user is following
     def get_count_links(self, uid) -> int:
         cursor = self.get_cursor()
         cursor.execute("""
             SELECT COUNT(*) as totale
-            FROM link
-            WHERE link.userid = ? 
+            FROM subscription
+            WHERE subscription.userid = ?
             """, (uid,))  # Count links associated with a specific user ID
         return cursor.fetchone()[0]  # Return the count of links
 
-    # Method to retrieve all task IDs associated with a specific user ID
-    def get_tasks(self, uid) -> list:
-        cursor = self.get_cursor()
-        cursor.execute("""
-            SELECT taskid
-            FROM link
-            WHERE link.userid = ? 
-            """, (uid,))  # Select task IDs for a specific user ID
-        return [tlp[0] for tlp in cursor.fetchall()]  # Return a list of task IDs
-
-    # Method to retrieve all task IDs from the link table
+    # Method to retrieve all task IDs from the monitor table
     def get_all_tasks(self) -> list:
         cursor = self.get_cursor()
         cursor.execute("""
             SELECT taskid
-            FROM link
-            """, )  # Select all task IDs from link table
+            FROM monitor
+            """, )  # Select all task IDs from monitor table
         return [tlp[0] for tlp in cursor.fetchall()]  # Return a list of task IDs
 
-    # Method to retrieve a specific task ID based on user ID and URL
-    def get_task(self, uid, url) -> str:
+    # Method to retrieve the task ID of the monitor checking a URL, or None if the URL is not monitored
+    def get_task(self, url) -> str:
         cursor = self.get_cursor()
         cursor.execute("""
             SELECT taskid
-            FROM link
-            WHERE link.userid = ? and link.url = ?
-            """, (uid, url))  # Select task ID for specific user ID and URL
-        return cursor.fetchone()[0]  # Return the task ID
+            FROM monitor
+            WHERE monitor.url = ?
+            """, (url,))  # Select task ID for a specific URL
+        row = cursor.fetchone()
+        return row[0] if row is not None else None  # Return the task ID
 
     # Method to retrieve a user's information based on their user ID
     def get_user(self, uid) -> str:
@@ -142,47 +244,288 @@ class Database:
         cursor = self.get_cursor()
         cursor.execute("""
         SELECT url
-        FROM link
-        WHERE link.userid = ? 
+        FROM subscription
+        WHERE subscription.userid = ?
         """, (uid,))  # Select URLs for a specific user ID
         return [tlp[0] for tlp in cursor.fetchall()]  # Return a list of URLs
 
+    # Method to retrieve every (user ID, URL) subscription, used to rebuild the registry on startup
+    def get_all_links(self) -> list:
+        cursor = self.get_cursor()
+        cursor.execute("""
+        SELECT userid, url
+        FROM subscription
+        """)  # Select all subscriptions
+        return cursor.fetchall()  # Return a list of (user ID, URL) pairs
+
+    # Method to retrieve the polling interval bounds chosen by every user who set them
+    def get_all_user_bounds(self) -> list:
+        cursor = self.get_cursor()
+        cursor.execute("""
+        SELECT userid, min_interval, max_interval
+        FROM user
+        WHERE min_interval IS NOT NULL OR max_interval IS NOT NULL
+        """)  # Select the bounds of the users who set them
+        return cursor.fetchall()  # Return a list of (user ID, minimum, maximum)
+
+    # Method to save the polling interval bounds chosen by a user
+    def set_user_bounds(self, uid, min_interval, max_interval):
+        cursor = self.get_cursor()
+        cursor.execute("""
+            UPDATE user
+            SET min_interval = ?, max_interval = ?
+            WHERE userid = ?
+            """, (min_interval, max_interval, uid))  # Update the bounds of a specific user
+        self._commit()  # Commit changes to the database
+
+    # Method to retrieve the IDs of all users following a specific URL
+    def get_subscribers(self, url) -> list:
+        cursor = self.get_cursor()
+        cursor.execute("""
+        SELECT userid
+        FROM subscription
+        WHERE subscription.url = ?
+        """, (url,))  # Select user IDs for a specific URL
+        return [tlp[0] for tlp in cursor.fetchall()]  # Return a list of user IDs
+
+    # Method to count how many users are following a specific URL
+    def get_count_subscribers(self, url) -> int:
+        cursor = self.get_cursor()
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM subscription
+            WHERE subscription.url = ?
+            """, (url,))  # Count users associated with a specific URL
+        return cursor.fetchone()[0]  # Return the count of users
+
     # Method to check if a specific URL already exists for a given user
     def check_link_exists(self, uid, url) -> bool:
         cursor = self.get_cursor()
         cursor.execute("""
             SELECT 1
-            FROM link
-            WHERE link.url = ? AND link.userid = ?
+            FROM subscription
+            WHERE subscription.url = ? AND subscription.userid = ?
             """, (url, uid))  # Check if URL exists for specific user ID
         return cursor.fetchone() is not None  # Return True if URL exists, else False
 
-    # Method to insert a new link into the link table
-    def insert_link(self, uid, url, tskid):
-        conn = self.get_conn()
+    # Method to insert a new monitor for a URL into the monitor table
+    def insert_monitor(self, url, tskid, kind=None):
         cursor = self.get_cursor()
         cursor.execute("""
-            INSERT INTO link (userid, url, taskid) VALUES (?, ?, ?)
-            """, (uid, url, tskid))  # Insert new link data into link table
-        conn.commit()  # Commit changes to the database
+            INSERT INTO monitor (url, taskid, kind) VALUES (?, ?, ?)
+            """, (url, tskid, kind))  # Insert new monitor data into monitor table
+        self._commit()  # Commit changes to the database
+
+    # Method to insert a new link into the subscription table
+    def insert_link(self, uid, url):
+        cursor = self.get_cursor()
+        cursor.execute("""
+            INSERT INTO subscription (userid, url) VALUES (?, ?)
+            """, (uid, url))  # Insert new link data into subscription table
+        self._commit()  # Commit changes to the database
 
     # Method to delete a user from the user table based on their user ID
     def delete_user(self, uid):
-        conn = self.get_conn()
         cursor = self.get_cursor()
         cursor.execute("""
             DELETE FROM user
             WHERE userid = ?
             """, (uid,))  # Delete specific user from user table
-        conn.commit()  # Commit changes to the database
+        self._commit()  # Commit changes to the database
 
     # Method to delete a specific link for a given user
     def delete_link(self, uid, url):
-        conn = self.get_conn()
         cursor = self.get_cursor()
         logging.info(f"Deleting link {url} for user {uid}.")
         cursor.execute("""  
-             DELETE FROM link  
+             DELETE FROM subscription
              WHERE userid = ? and url = ?  
              """, (uid, url))
-        conn.commit()
+        self._commit()
+
+    # Method to delete the monitor of a URL, along with its snapshots
+    def delete_monitor(self, url):
+        cursor = self.get_cursor()
+        logging.info(f"Deleting monitor for {url}.")
+        cursor.execute("""
+             SELECT DISTINCT digest
+             FROM snapshot
+             WHERE url = ?
+             """, (url,))
+        digests = [tlp[0] for tlp in cursor.fetchall()]
+        cursor.execute("""
+             DELETE FROM monitor
+             WHERE url = ?
+             """, (url,))  # Snapshots are deleted in cascade
+        self._delete_unreferenced_blobs(digests)
+        self._commit()
+
+    # Method to retrieve the saved state of every monitor, used to rebuild them on startup
+    def get_monitors(self) -> list:
+        cursor = self.get_cursor()
+        cursor.execute("""
+            SELECT url, digest, length, etag, last_modified, next_check, interval, checks, changes, last_change, selector, masks,
+                   fetch_bytes, fetch_cpu, kind
+            FROM monitor
+            ORDER BY next_check
+            """)  # Select the state of all monitors, the most overdue first
+        return cursor.fetchall()  # Return a list of monitor states
+
+    # Method to save the task IDs of many monitors in a single transaction
+    def set_tasks(self, tasks):
+        cursor = self.get_cursor()
+        cursor.executemany("""
+            UPDATE monitor
+            SET taskid = ?
+            WHERE url = ?
+            """, tasks)  # Update the task ID of each (taskid, url) pair
+        self._commit()  # Commit changes to the database
+
+    # Method to save the state of a monitor after a check
+    def update_monitor(self, url, digest, length, etag, last_modified, next_check, interval, checks, changes, last_change, fetch_bytes, fetch_cpu):
+        cursor = self.get_cursor()
+        cursor.execute("""
+            UPDATE monitor
+            SET digest = ?, length = ?, etag = ?, last_modified = ?, next_check = ?,
+                interval = ?, checks = ?, changes = ?, last_change = ?, fetch_bytes = ?, fetch_cpu = ?
+            WHERE url = ?
+            """, (digest, length, etag, last_modified, next_check, interval, checks, changes, last_change, fetch_bytes, fetch_cpu, url))  # Update the state of the URL
+        self._commit()  # Commit changes to the database
+
+
+    # Method to save the extraction pipeline of a monitor (masks are a JSON list), forgetting its digest and validators
+    def set_monitor_pipeline(self, url, selector, masks):
+        cursor = self.get_cursor()
+        cursor.execute("""
+            UPDATE monitor
+            SET selector = ?, masks = ?, digest = NULL, length = 0, etag = NULL, last_modified = NULL
+            WHERE url = ?
+            """, (selector, masks, url))  # Update the pipeline of the URL
+        self._commit()  # Commit changes to the database
+
+    # Private method to delete the blobs among the given digests that no snapshot refers to anymore
+    def _delete_unreferenced_blobs(self, digests):
+        cursor = self.get_cursor()
+        cursor.executemany("""
+            DELETE FROM blob
+            WHERE digest = ? AND NOT EXISTS (SELECT 1 FROM snapshot WHERE snapshot.digest = blob.digest)
+            """, [(digest,) for digest in digests])
+
+    # Method to save a snapshot of a URL, storing its compressed body only if no other snapshot has the same digest,
+    # and to delete the oldest snapshots of the URL beyond the retention
+    def insert_snapshot(self, url, digest, codec, data, size, taken_at, retention):
+        cursor = self.get_cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO blob (digest, codec, data, size) VALUES (?, ?, ?, ?)
+            """, (digest, codec, data, size))  # Insert the body only once for each digest
+        cursor.execute("""
+            INSERT INTO snapshot (url, digest, taken_at) VALUES (?, ?, ?)
+            """, (url, digest, taken_at))  # Insert new snapshot data into snapshot table
+        cursor.execute("""
+            SELECT id, digest
+            FROM snapshot
+            WHERE url = ?
+            ORDER BY taken_at DESC
+            LIMIT -1 OFFSET ?
+            """, (url, retention))  # Select the snapshots beyond the retention
+        expired = cursor.fetchall()
+        cursor.executemany("""
+            DELETE FROM snapshot
+            WHERE id = ?
+            """, [(tlp[0],) for tlp in expired])
+        self._delete_unreferenced_blobs({tlp[1] for tlp in expired})
+        self._commit()  # Commit changes to the database
+
+    # Method to retrieve the codec and compressed body of the latest snapshot of a URL, or None if there is none
+    def get_latest_snapshot(self, url) -> tuple:
+        cursor = self.get_cursor()
+        cursor.execute("""
+            SELECT blob.codec, blob.data
+            FROM snapshot JOIN blob ON snapshot.digest = blob.digest
+            WHERE snapshot.url = ?
+            ORDER BY snapshot.taken_at DESC
+            LIMIT 1
+            """, (url,))  # Select the body of the most recent snapshot of a specific URL
+        return cursor.fetchone()  # Return the codec and body of the snapshot
+
+
+class AsyncDatabase:
+    # Initialize the asynchronous access layer: every call to the database runs on a dedicated thread,
+    # and high-frequency writes are buffered and committed together every flush_interval seconds
+    def __init__(self, database, flush_interval, max_batch, metrics):
+        self._metrics = metrics
+        self._db = database
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Database")
+        self._pending = []  # Buffered (method name, arguments) writes
+        self._flush_task = None
+        self._batch_full = asyncio.Event()  # Set when a full batch is waiting, to flush it before the end of the interval
+
+    def get_database(self):
+        return self._db
+
+    def get_flush_interval(self):
+        return self._flush_interval
+
+    def get_max_batch(self):
+        return self._max_batch
+
+    def get_metrics(self):
+        return self._metrics
+
+    # Method to return the number of buffered writes
+    def get_pending(self) -> int:
+        return len(self._pending)
+
+    # Expose every method of Database as a coroutine running on the database thread
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+
+        async def call(*args):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args))
+        return call
+
+    # Method to start the periodic flush of buffered writes
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_periodically(), name="Database-flush")
+
+    # Method to buffer a write, which will be committed together with the other buffered writes
+    def queue_write(self, name, *args):
+        self._pending.append((name, args))
+        if len(self._pending) >= self.get_max_batch():
+            # Wake the periodic flusher, which owns the flush task and logs its errors
+            self._batch_full.set()
+
+    # Method to commit all buffered writes in a single transaction
+    async def flush(self):
+        if not self._pending:
+            return
+        writes, self._pending = self._pending, []
+        start = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._db.run_batch, writes)
+        self.get_metrics().get_db_write_latency().observe(time.monotonic() - start)
+
+    # Private method that flushes the buffered writes every flush_interval seconds, or as soon as a batch is full
+    async def _flush_periodically(self):
+        while True:
+            # wait, unlike wait_for, lets the cancellation of close() through even if a batch fills up at the same time
+            batch_full = asyncio.ensure_future(self._batch_full.wait())
+            try:
+                await asyncio.wait([batch_full], timeout=self.get_flush_interval())
+            finally:
+                batch_full.cancel()
+            self._batch_full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing database writes: {e}")
+
+    # Method to stop the periodic flush, commit the remaining writes and release the database thread
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        logging.info("Database writes flushed.")
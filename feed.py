@@ -0,0 +1,150 @@
+from xml.etree import ElementTree
+from normalizer import Normalizer
+from fetcher import BodyTooLargeError
+import logging
+import zlib
+
+
+class FeedStream:
+    # Magic bytes of a gzip-compressed body, such as a sitemap.xml.gz served without Content-Encoding
+    GZIP_MAGIC = b"\x1f\x8b"
+
+    # Initialize the incremental parsing of a sitemap, RSS or Atom feed: the body is turned into one "URL<TAB>version" line
+    # per entry, in document order, so that its digest only changes when an entry is added, removed or updated
+    # A compressed body is decompressed up to max_size bytes, like the bodies decoded by the HTTP client
+    def __init__(self, max_entries, max_size):
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._parser = ElementTree.XMLPullParser(events=("end",))
+        self._decompressor = None  # Set when the body turns out to be gzip-compressed
+        self._decompressed = 0  # Number of bytes decompressed so far
+        self._started = False  # Whether the first bytes of the body have been seen
+        self._entries = 0  # Number of entries written so far
+        self._stopped = False  # Set once the feed is invalid or has too many entries, the rest of the body is ignored
+
+    # Method to return the encoding of the normalized body
+    def get_encoding(self, encoding):
+        return "utf-8"
+
+    # Method to parse the next chunk of the body, returning the lines of the entries completed so far
+    def feed(self, chunk) -> bytes:
+        if self._stopped:
+            return b""
+        if not self._started and chunk:
+            self._started = True
+            if chunk.startswith(self.GZIP_MAGIC):
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._decompressor is not None:
+            try:
+                # One byte over the limit is enough to know the body is too large, the rest is never decompressed
+                chunk = self._decompressor.decompress(chunk, self._max_size - self._decompressed + 1)
+            except zlib.error as e:
+                logging.warning(f"Invalid compressed feed, the entries after the error are ignored: {e}")
+                self._stopped = True
+                return b""
+            self._decompressed += len(chunk)
+            if self._decompressed > self._max_size:
+                raise BodyTooLargeError(f"more than {self._max_size} bytes once decompressed")
+        return self._parse(chunk, self._parser.feed)
+
+    # Method to complete the parsing, returning the lines of the remaining entries
+    def close(self) -> bytes:
+        return self._parse(None, lambda _: self._parser.close())
+
+    # Private method to run a step of the parser and write the entries it completed
+    def _parse(self, chunk, step) -> bytes:
+        if self._stopped:
+            return b""
+        try:
+            step(chunk)
+        except ElementTree.ParseError as e:
+            logging.warning(f"Invalid feed, the entries after the error are ignored: {e}")
+            self._stopped = True
+        lines = []
+        for _, element in self._parser.read_events():
+            entry = self._read_entry(element)
+            if entry is None:
+                continue
+            element.clear()  # The entry is written out, so its content is not kept in memory
+            if self._entries >= self._max_entries:
+                self._stopped = True
+                break
+            self._entries += 1
+            lines.append(f"{entry[0]}\t{entry[1]}\n")
+        return "".join(lines).encode()
+
+    # Private method to read the (URL, version) pair of a sitemap <url>, RSS <item> or Atom <entry> element, or None for other elements
+    # The version is <lastmod> in a sitemap, the update or publication date (or the ID) of a feed entry, and empty when unknown
+    @staticmethod
+    def _read_entry(element):
+        tag = FeedStream._local_name(element.tag)
+        if tag not in ("url", "item", "entry"):
+            return None
+        children = {}
+        link = None
+        for child in element:
+            name = FeedStream._local_name(child.tag)
+            if name == "link" and tag == "entry":
+                # Atom links are attributes, the alternate link being the page of the entry
+                if child.get("rel", "alternate") == "alternate" and link is None:
+                    link = child.get("href")
+            else:
+                children.setdefault(name, (child.text or "").strip())
+        if tag == "url":
+            url, version = children.get("loc"), children.get("lastmod")
+        elif tag == "item":
+            url = children.get("link") or children.get("guid")
+            version = children.get("updated") or children.get("date") or children.get("pubDate") or children.get("guid")
+        else:
+            url = link or children.get("id")
+            version = children.get("updated") or children.get("published") or children.get("id")
+        if not url or not url.startswith(("http://", "https://")) or any(c.isspace() for c in url):
+            return None
+        return url, " ".join((version or "").split())
+
+    # Private method to strip the namespace of a tag
+    @staticmethod
+    def _local_name(tag) -> str:
+        return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+class FeedNormalizer:
+    # Maximum number of entries read from a feed, the limit of a single sitemap file
+    MAX_ENTRIES = 50000
+
+    # Initialize the extraction pipeline of a feed: the feed itself is reduced to its entries,
+    # the optional region and masks apply to the pages it lists
+    def __init__(self, selector=None, masks=()):
+        self._page_normalizer = Normalizer(selector, masks)
+
+    # Method to return the extraction pipeline of the pages listed by the feed
+    def get_page_normalizer(self) -> Normalizer:
+        return self._page_normalizer
+
+    # Method to start the parsing of a feed body, whatever its content type
+    def stream(self, content_type, encoding, max_size) -> FeedStream:
+        return FeedStream(self.MAX_ENTRIES, max_size)
+
+    # Method to read the entries written by a FeedStream, as a map of URL to version
+    @staticmethod
+    def read_entries(data: bytes) -> dict:
+        entries = {}
+        for line in data.decode().splitlines():
+            url, _, version = line.partition("\t")
+            entries.setdefault(url, version)
+        return entries
+
+    # Method to read the state of a feed saved after a check, as a map of URL to (version, digest of the page)
+    # The digest is empty for the pages listed before they were ever fetched
+    @staticmethod
+    def read_state(data: bytes) -> dict:
+        state = {}
+        for line in data.decode().splitlines():
+            url, version, digest = line.split("\t")
+            state[url] = (version, digest)
+        return state
+
+    # Method to write the state of a feed, as one "URL<TAB>version<TAB>digest" line per page
+    @staticmethod
+    def write_state(state: dict) -> bytes:
+        return "".join(f"{url}\t{version}\t{digest}\n" for url, (version, digest) in state.items()).encode()
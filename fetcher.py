@@ -0,0 +1,346 @@
+from httpx import RequestError, HTTPStatusError, AsyncClient, Response, Limits, Timeout, ConnectError, ReadError, WriteError, RemoteProtocolError
+from urllib.parse import urlparse
+from circuitbreaker import CircuitBreaker
+from snapshot import Snapshot
+from metrics import Metrics
+from normalizer import Normalizer
+from latency import LatencyTracker
+import hashlib
+import logging
+import asyncio
+import time
+
+try:
+    import h2  # HTTP/2 support is only available when the h2 package is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import brotli  # httpx decodes brotli responses only when the brotli package is installed
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+
+class FetchResult:
+    # Initialize the outcome of a fetch: the digest and length of the body (None if not modified or failed)
+    # and the validators returned by the server
+    # When the circuit of the host is open, no request is sent and retry_after tells when to try again
+    # The compressed body (snapshot) is only kept until the check that requested it is over
+    # size and cpu are the cost of the fetch: bytes received on the wire and CPU seconds spent normalizing the body
+    def __init__(self, digest, length=0, etag=None, last_modified=None, not_modified=False, retry_after=0.0, snapshot=None, encoding=None,
+                 size=0, cpu=0.0):
+        self._digest = digest
+        self._length = length
+        self._snapshot = snapshot
+        self._encoding = encoding
+        self._etag = etag
+        self._last_modified = last_modified
+        self._not_modified = not_modified
+        self._retry_after = retry_after
+        self._size = size
+        self._cpu = cpu
+
+    def get_digest(self):
+        return self._digest
+
+    def get_length(self):
+        return self._length
+
+    def get_snapshot(self):
+        return self._snapshot
+
+    def get_encoding(self):
+        return self._encoding
+
+    def get_etag(self):
+        return self._etag
+
+    def get_last_modified(self):
+        return self._last_modified
+
+    def is_not_modified(self):
+        return self._not_modified
+
+    # Method to check whether the fetch failed or was skipped, in which case there is no digest to compare
+    def is_failed(self):
+        return self._digest is None and not self._not_modified
+
+    def get_retry_after(self):
+        return self._retry_after
+
+    def get_size(self):
+        return self._size
+
+    def get_cpu(self):
+        return self._cpu
+
+
+class BodyTooLargeError(Exception):
+    pass
+
+
+class Fetcher:
+    # Errors raised when a connection fails or is dropped before the response arrives, after which the request is sent again
+    RETRIED_ERRORS = (ConnectError, ReadError, WriteError, RemoteProtocolError)
+
+    # Initialize the long-lived HTTP client shared by every check, with its connection pool limits and timeouts:
+    # connect_timeout to open a connection, read_timeout for each read, total_timeout for the whole fetch including retries
+    # Once the response of a host is slower than the hedge_percentile of its recent latencies, a hedged copy of the request is sent
+    # (None disables hedging), and a request whose connection is dropped before the response is sent up to retries more times
+    def __init__(self, max_connections, max_keepalive_connections, max_connections_per_host, max_body_size, breaker: CircuitBreaker,
+                 snapshot_level, metrics: Metrics, latency: LatencyTracker, connect_timeout, read_timeout, total_timeout, hedge_percentile, retries,
+                 keepalive_expiry=30.0):
+        self._metrics = metrics
+        self._latency = latency  # Recent latencies of each host, driving the hedged requests
+        self._total_timeout = total_timeout
+        self._hedge_percentile = hedge_percentile
+        self._retries = retries
+        self._max_connections_per_host = max_connections_per_host
+        self._max_body_size = max_body_size
+        self._snapshot_level = snapshot_level
+        self._breaker = breaker  # Health of each host, to stop sending requests to hosts that keep failing
+        self._host_semaphores = {}  # Map of host to the semaphore capping its concurrent requests
+        self._client = AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=Timeout(read_timeout, connect=connect_timeout),
+            limits=Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive_connections,
+                          keepalive_expiry=keepalive_expiry),
+            headers={"Accept-Encoding": "br, gzip, deflate" if BROTLI_AVAILABLE else "gzip, deflate"},
+        )
+        if not HTTP2_AVAILABLE:
+            logging.warning("The h2 package is not installed, falling back to HTTP/1.1.")
+
+    def get_client(self):
+        return self._client
+
+    def get_max_connections_per_host(self):
+        return self._max_connections_per_host
+
+    def get_max_body_size(self):
+        return self._max_body_size
+
+    def get_breaker(self):
+        return self._breaker
+
+    def get_snapshot_level(self):
+        return self._snapshot_level
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_latency(self):
+        return self._latency
+
+    def get_total_timeout(self):
+        return self._total_timeout
+
+    def get_hedge_percentile(self):
+        return self._hedge_percentile
+
+    def get_retries(self):
+        return self._retries
+
+    # Method to close the client and all of its pooled connections
+    async def close(self):
+        await self.get_client().aclose()
+        logging.info("HTTP client closed.")
+
+    # Method to extract the host of a URL, which is the key of the per-host limits and health
+    @staticmethod
+    def get_host(url) -> str:
+        return urlparse(url).netloc.lower()
+
+    # Private method to retrieve (or create) the semaphore limiting concurrent requests to a host
+    def _get_host_semaphore(self, host):
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.get_max_connections_per_host())
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    # Private method to normalize, hash and compress the body of a response while it streams in, without keeping it in memory
+    # The digest and the snapshot are those of the normalized body, the length is the one of the body received
+    # Parsing, masking, hashing and compressing run off the event loop, one chunk at a time, so a large page does not stall the other checks
+    async def _digest_body(self, response: Response, normalizer: Normalizer) -> tuple:
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.get_max_body_size():
+            raise BodyTooLargeError(content_length)
+        digest = hashlib.sha256()
+        compressor = Snapshot.compressor(self.get_snapshot_level())
+        stream = normalizer.stream(response.headers.get("Content-Type"), response.charset_encoding or "utf-8", self.get_max_body_size())
+        compressed = []
+
+        # Normalize a chunk (or complete the body when chunk is None), returning the CPU time it took on its thread
+        def process(chunk) -> float:
+            start = time.thread_time()
+            normalized = stream.feed(chunk) if chunk is not None else stream.close()
+            digest.update(normalized)
+            compressed.append(compressor.compress(normalized))
+            return time.thread_time() - start
+
+        length = 0
+        cpu = 0.0
+        async for chunk in response.aiter_bytes():
+            length += len(chunk)
+            if length > self.get_max_body_size():
+                raise BodyTooLargeError(length)
+            cpu += await asyncio.to_thread(process, chunk)
+        cpu += await asyncio.to_thread(process, None)
+        compressed.append(compressor.flush())
+        return digest.hexdigest(), length, b"".join(compressed), stream.get_encoding(response.charset_encoding or "utf-8"), cpu
+
+    # Private method to send a request and wait for its response headers, sending it again when its connection fails or is dropped
+    # before the response arrives, as long as the total timeout of the fetch allows it
+    async def _send(self, url, host, headers) -> Response:
+        for attempt in range(self.get_retries() + 1):
+            try:
+                return await self._send_hedged(url, host, headers)
+            except self.RETRIED_ERRORS as e:
+                if attempt == self.get_retries():
+                    raise
+                logging.warning(f"Sending the request to {url} again after: {e!r}")
+                self.get_metrics().get_extra_requests().inc("retry")
+
+    # Private method to send a request and wait for its response headers: once the host is slower than the hedge percentile
+    # of its recent latencies, a hedged copy of the request is sent and the first response wins, the other request being cancelled
+    # The hedged copy is only sent when the host has a spare connection slot, so hedging never exceeds the per-host limit
+    async def _send_hedged(self, url, host, headers) -> Response:
+        client = self.get_client()
+        semaphore = self._get_host_semaphore(host)
+        starts = {}  # Map of each request task to the monotonic time it was sent
+        winner = None
+        hedged = False
+
+        def send():
+            task = asyncio.create_task(client.send(client.build_request("GET", url, headers=headers), stream=True))
+            starts[task] = time.monotonic()
+            return task
+
+        pending = {send()}
+        try:
+            delay = None
+            if self.get_hedge_percentile() is not None:
+                delay = self.get_latency().get_percentile(host, self.get_hedge_percentile())
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done and not semaphore.locked():
+                    await semaphore.acquire()
+                    hedged = True
+                    pending.add(send())
+                    self.get_metrics().get_extra_requests().inc("hedge")
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task.result()
+                        self.get_latency().record(host, time.monotonic() - starts[task])
+                        return winner
+                    error = error or task.exception()
+            # Every request failed: raise the error of the first one to fail
+            raise error
+        finally:
+            for task in starts:
+                task.cancel()
+            # Close the response of a request that arrived together with the winner
+            for result in await asyncio.gather(*starts, return_exceptions=True):
+                if isinstance(result, Response) and result is not winner:
+                    await result.aclose()
+            if hedged:
+                semaphore.release()
+
+    # Method to download a URL and compute the digest of its body, recording the latency and outcome of the fetch
+    async def fetch_url_content(self, url: str, etag=None, last_modified=None, normalizer: Normalizer = None) -> FetchResult:
+        start = time.monotonic()
+        result = await self._fetch(url, etag, last_modified, normalizer or Normalizer())
+        if result.get_retry_after() > 0:
+            outcome = "skipped"
+        elif result.is_not_modified():
+            outcome = "not_modified"
+        elif result.is_failed():
+            outcome = "error"
+        else:
+            outcome = "ok"
+        self.get_metrics().record_fetch(self.get_host(url), outcome, time.monotonic() - start)
+        return result
+
+    # Private method to download a URL and compute the digest of its body, within the total timeout of a fetch
+    # The validators of the previous response are sent so that an unchanged page is answered with 304 and no body
+    async def _fetch(self, url: str, etag, last_modified, normalizer: Normalizer) -> FetchResult:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        host = self.get_host(url)
+        if not self.get_breaker().allow(host):
+            # The host keeps failing: skip the request until its circuit lets a probe through
+            return FetchResult(None, 0, etag, last_modified, retry_after=self.get_breaker().retry_after(host))
+        try:
+            async with self._get_host_semaphore(host):
+                # The total timeout starts once a connection slot to the host is ours, so the time queued behind the other
+                # requests to the host is not held against it; it covers the retries and hedged requests, and the whole body
+                return await asyncio.wait_for(self._request(url, host, headers, etag, last_modified, normalizer), self.get_total_timeout())
+        except asyncio.TimeoutError:
+            # Log fetches exceeding their total time budget, which count against the health of the host.
+            logging.error(f"Fetch of {url} exceeded {self.get_total_timeout()} seconds.")
+            self.get_breaker().record_failure(host)
+            return FetchResult(None, 0, etag, last_modified)
+        except asyncio.CancelledError:
+            # Let another request probe the host if this one was the probe of a half-open circuit, cancelled while queued
+            self.get_breaker().release(host)
+            raise
+
+    # Private method to send the request of a fetch and read its response, reusing pooled connections
+    # The caller holds a connection slot to the host
+    async def _request(self, url: str, host, headers, etag, last_modified, normalizer: Normalizer) -> FetchResult:
+        try:
+            response = await self._send(url, host, headers)
+            try:
+                if response.status_code == 304:
+                    self.get_breaker().record_success(host)
+                    # Keep the validators we sent if the server does not repeat them
+                    return FetchResult(None, 0, response.headers.get("ETag", etag), response.headers.get("Last-Modified", last_modified), not_modified=True,
+                                       size=response.num_bytes_downloaded)
+                response.raise_for_status()
+                digest, length, snapshot, encoding, cpu = await self._digest_body(response, normalizer)
+                self.get_breaker().record_success(host)
+                # The body has been read entirely, so the bytes received so far are the size of the response
+                return FetchResult(digest, length, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                   snapshot=snapshot, encoding=encoding, size=response.num_bytes_downloaded, cpu=cpu)
+            finally:
+                await response.aclose()
+                # Count the bytes received on the wire, before decompression
+                self.get_metrics().get_fetch_bytes().inc(host, amount=response.num_bytes_downloaded)
+        except HTTPStatusError as e:
+            # Log HTTP errors encountered while fetching URL content.
+            logging.error(f"HTTP error for {url}: {e.response.status_code}")
+            # Server errors and rate limiting count against the health of the host, other errors are specific to the URL
+            if e.response.status_code >= 500 or e.response.status_code == 429:
+                self.get_breaker().record_failure(host)
+            else:
+                self.get_breaker().record_success(host)
+            return FetchResult(None, 0, etag, last_modified)
+        except RequestError as e:
+            # Log request errors encountered while fetching URL content.
+            logging.error(f"Request error for {url}: {e}")
+            self.get_breaker().record_failure(host)
+            return FetchResult(None, 0, etag, last_modified)
+        except BodyTooLargeError as e:
+            # Log responses whose body exceeds the configured maximum size.
+            logging.error(f"Body of {url} exceeds {self.get_max_body_size()} bytes ({e}).")
+            self.get_breaker().record_success(host)
+            return FetchResult(None, 0, etag, last_modified)
+        except asyncio.CancelledError:
+            # Let another request probe the host if this one was the probe of a half-open circuit
+            self.get_breaker().release(host)
+            raise
+        except Exception as e:
+            # Log any other error while reading the response, which counts against the health of the host,
+            # so that the probe of a half-open circuit is always settled
+            logging.error(f"Unexpected error fetching {url}: {e!r}")
+            self.get_breaker().record_failure(host)
+            return FetchResult(None, 0, etag, last_modified)
@@ -0,0 +1,37 @@
+import collections
+import math
+
+
+class LatencyTracker:
+    # Initialize the record of the recent latencies of each host: the last window durations until the response headers,
+    # a percentile being estimated only once at least min_samples durations are known
+    def __init__(self, window, min_samples):
+        self._window = window
+        self._min_samples = min_samples
+        self._hosts = {}  # Map of host to the deque of its recent latencies
+
+    def get_window(self):
+        return self._window
+
+    def get_min_samples(self):
+        return self._min_samples
+
+    # Method to record the latency (in seconds) of a request to a host
+    def record(self, host, latency):
+        latencies = self._hosts.get(host)
+        if latencies is None:
+            latencies = collections.deque(maxlen=self.get_window())
+            self._hosts[host] = latencies
+        latencies.append(latency)
+
+    # Method to estimate a percentile (between 0 and 1) of the recent latencies of a host, or None if too few are known
+    def get_percentile(self, host, q):
+        latencies = self._hosts.get(host)
+        if latencies is None or len(latencies) < self.get_min_samples():
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(math.ceil(q * len(ordered)) - 1, len(ordered) - 1)]
+
+    # Method to return the number of hosts whose latencies are recorded
+    def count(self) -> int:
+        return len(self._hosts)
@@ -0,0 +1,280 @@
+import logging
+import asyncio
+import bisect
+import time
+
+
+class Counter:
+    # Initialize a counter, one value for each combination of label values
+    def __init__(self, name, description, labels=()):
+        self._name = name
+        self._description = description
+        self._labels = labels
+        self._values = {}
+
+    def get_name(self):
+        return self._name
+
+    # Method to increase the counter of the given label values
+    def inc(self, *label_values, amount=1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    # Method to return the total of the counter over all label values matching the given filter
+    def total(self, **label_filter) -> float:
+        indexes = {self._labels.index(label): value for label, value in label_filter.items()}
+        return sum(value for key, value in self._values.items() if all(key[i] == v for i, v in indexes.items()))
+
+    # Method to return the values counted since the last call and start again from zero
+    def drain(self) -> dict:
+        values, self._values = self._values, {}
+        return values
+
+    # Method to add the values drained from the same counter in another process
+    def merge(self, values):
+        for key, value in values.items():
+            self.inc(*key, amount=value)
+
+    # Method to render the counter in the Prometheus text format
+    def render(self) -> list:
+        lines = [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self._name}{Metrics.format_labels(self._labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    # Initialize a gauge, whose value is either set explicitly or read from a function when rendered
+    def __init__(self, name, description, function=None):
+        self._name = name
+        self._description = description
+        self._function = function
+        self._value = 0.0
+
+    def get_name(self):
+        return self._name
+
+    def set(self, value):
+        self._value = value
+
+    def get(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+    # Method to render the gauge in the Prometheus text format
+    def render(self) -> list:
+        return [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} gauge", f"{self._name} {self.get()}"]
+
+
+class Histogram:
+    # Initialize a histogram with the upper bounds of its buckets
+    def __init__(self, name, description, buckets):
+        self._name = name
+        self._description = description
+        self._buckets = sorted(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)  # The last bucket counts the observations above every bound
+        self._sum = 0.0
+        self._count = 0
+
+    def get_name(self):
+        return self._name
+
+    def get_count(self):
+        return self._count
+
+    # Method to record an observation
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    # Method to return the observations recorded since the last call and start again from zero
+    def drain(self) -> tuple:
+        state = (self._counts, self._sum, self._count)
+        self._counts, self._sum, self._count = [0] * len(self._counts), 0.0, 0
+        return state
+
+    # Method to add the observations drained from the same histogram in another process
+    def merge(self, state):
+        counts, total, count = state
+        self._counts = [a + b for a, b in zip(self._counts, counts)]
+        self._sum += total
+        self._count += count
+
+    # Method to estimate a quantile (between 0 and 1) as the upper bound of the bucket containing it
+    def quantile(self, q) -> float:
+        if self._count == 0:
+            return 0.0
+        rank = q * self._count
+        cumulative = 0
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    # Method to render the histogram in the Prometheus text format
+    def render(self) -> list:
+        lines = [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            lines.append(f'{self._name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self._name}_bucket{{le="+Inf"}} {self._count}')
+        lines.append(f"{self._name}_sum {self._sum}")
+        lines.append(f"{self._name}_count {self._count}")
+        return lines
+
+
+class Metrics:
+    # Buckets (in seconds) of the latency histograms
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    # Buckets (in seconds) of the scheduler lag histogram
+    LAG_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    # Initialize the metrics of the monitoring loop
+    def __init__(self, loop_lag_interval):
+        self._loop_lag_interval = loop_lag_interval
+        self._fetch_latency = Histogram("peppy_fetch_latency_seconds", "Duration of the fetches.", self.LATENCY_BUCKETS)
+        self._fetches = Counter("peppy_fetches_total", "Fetches by host and outcome (ok, not_modified, error, skipped).", ("host", "outcome"))
+        self._fetch_bytes = Counter("peppy_fetch_bytes_total", "Bytes downloaded by host.", ("host",))
+        self._extra_requests = Counter("peppy_fetch_extra_requests_total", "Requests sent again by kind (hedge, retry).", ("kind",))
+        self._scheduler_lag = Histogram("peppy_scheduler_lag_seconds", "Delay between the time a check is due and the time it starts.", self.LAG_BUCKETS)
+        self._loop_lag = Histogram("peppy_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task.", self.LATENCY_BUCKETS)
+        self._db_write_latency = Histogram("peppy_db_write_latency_seconds", "Duration of the database write transactions.", self.LATENCY_BUCKETS)
+        self._gauges = []
+        self._collector = None  # Coroutine function merging the metrics of the fetch worker processes before they are read
+        self._server = None
+        self._probe_task = None
+
+    def get_fetch_latency(self):
+        return self._fetch_latency
+
+    def get_fetches(self):
+        return self._fetches
+
+    def get_fetch_bytes(self):
+        return self._fetch_bytes
+
+    def get_extra_requests(self):
+        return self._extra_requests
+
+    def get_scheduler_lag(self):
+        return self._scheduler_lag
+
+    def get_loop_lag(self):
+        return self._loop_lag
+
+    def get_db_write_latency(self):
+        return self._db_write_latency
+
+    # Method to add a gauge whose value is read from a function, such as the depth of a queue
+    def add_gauge(self, name, description, function):
+        self._gauges.append(Gauge(name, description, function))
+
+    # Method to set the coroutine function collecting the metrics of the fetch worker processes
+    def set_collector(self, collector):
+        self._collector = collector
+
+    # Method to merge the metrics of the fetch worker processes, if any, so that they are included in the next reading
+    async def collect(self):
+        if self._collector is not None:
+            try:
+                await self._collector()
+            except Exception as e:
+                logging.error(f"Error collecting the metrics of the fetch worker processes: {e}")
+
+    # Private method to return the counters and histograms, in the order they are rendered
+    def _get_recorded(self) -> list:
+        return [self._fetch_latency, self._fetches, self._fetch_bytes, self._extra_requests, self._scheduler_lag, self._loop_lag, self._db_write_latency]
+
+    # Method to return the counters and histograms recorded since the last call, to be merged into the metrics of another process
+    def drain(self) -> dict:
+        return {metric.get_name(): metric.drain() for metric in self._get_recorded()}
+
+    # Method to add the counters and histograms drained from another process
+    def merge(self, drained):
+        for metric in self._get_recorded():
+            if metric.get_name() in drained:
+                metric.merge(drained[metric.get_name()])
+
+    # Method to format label names and values in the Prometheus text format
+    @staticmethod
+    def format_labels(names, values) -> str:
+        if not names:
+            return ""
+        pairs = []
+        for name, value in zip(names, values):
+            escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{name}="{escaped}"')
+        return "{" + ",".join(pairs) + "}"
+
+    # Method to record the outcome of a fetch
+    def record_fetch(self, host, outcome, latency):
+        self._fetches.inc(host, outcome)
+        if outcome != "skipped":
+            self._fetch_latency.observe(latency)
+
+    # Method to render every metric in the Prometheus text format
+    def render(self) -> str:
+        lines = []
+        for metric in self._get_recorded() + self._gauges:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # Method to summarize the metrics in a short human-readable text
+    def summary(self) -> str:
+        total = self._fetches.total()
+        text = f"Fetches: {int(total)} ({int(self._fetches.total(outcome='not_modified'))} not modified, " \
+               f"{int(self._fetches.total(outcome='error'))} errors, {int(self._fetches.total(outcome='skipped'))} skipped)\n" \
+               f"Downloaded: {self._fetch_bytes.total() / 1024 / 1024:.1f} MB\n" \
+               f"Extra requests: {int(self._extra_requests.total(kind='hedge'))} hedged, {int(self._extra_requests.total(kind='retry'))} retried\n" \
+               f"Fetch latency: p50 {self._fetch_latency.quantile(0.5)} s, p99 {self._fetch_latency.quantile(0.99)} s\n" \
+               f"Scheduler lag: p50 {self._scheduler_lag.quantile(0.5)} s, p99 {self._scheduler_lag.quantile(0.99)} s\n" \
+               f"Event loop lag: p99 {self._loop_lag.quantile(0.99)} s\n" \
+               f"DB write latency: p99 {self._db_write_latency.quantile(0.99)} s\n"
+        for gauge in self._gauges:
+            text += f"{gauge.get_name()}: {gauge.get()}\n"
+        return text
+
+    # Method to start the event loop lag probe and, if a port is given, the local Prometheus endpoint
+    async def start(self, host, port):
+        self._probe_task = asyncio.create_task(self._probe_loop_lag(), name="Metrics-loop-lag")
+        if port:
+            self._server = await asyncio.start_server(self._serve, host, port)
+            logging.info(f"Metrics available at http://{host}:{port}/metrics")
+
+    # Method to stop the probe and the endpoint
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # Private method measuring how late the event loop wakes up a task sleeping for a fixed interval
+    async def _probe_loop_lag(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self._loop_lag_interval)
+            self._loop_lag.observe(max(time.monotonic() - start - self._loop_lag_interval, 0.0))
+
+    # Private method answering a single HTTP request of the metrics endpoint
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers of the request
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                await self.collect()
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,185 @@
+from normalizer import Normalizer
+from feed import FeedNormalizer
+import time
+
+
+class Monitor:
+    # Factor applied to the interval after a check that found no change
+    BACKOFF = 1.5
+    # Factor applied to the interval after a check that found a change
+    TIGHTEN = 0.5
+    # Weight of the latest check in the average cost of a check
+    COST_SMOOTHING = 0.2
+    # Kind of a monitor following a sitemap or an RSS/Atom feed instead of a single page
+    FEED = "feed"
+
+    # Initialize the state kept between two checks of a monitored URL, shared by all of its subscribers
+    def __init__(self, url, interval, digest=None, length=0, etag=None, last_modified=None, checks=0, changes=0, last_change=None,
+                 selector=None, masks=(), fetch_bytes=None, fetch_cpu=None, kind=None):
+        self._url = url
+        self._kind = kind  # None for a page, FEED for a sitemap or feed whose listed pages are checked
+        self._task_name = None  # Name of the scheduler job checking the URL
+        # Only the digest and length of the last body are kept, so memory does not grow with the page size
+        self._digest = digest
+        self._length = length
+        # Validators of the last response, sent back to the server to make the next request conditional
+        self._etag = etag
+        self._last_modified = last_modified
+        # Current polling interval (in seconds) and change statistics driving it
+        self._interval = interval
+        self._checks = checks
+        self._changes = changes
+        self._last_change = last_change
+        self._failures = 0  # Consecutive failed fetches
+        # Extraction pipeline applied to the body before its digest is computed, so that volatile parts do not count as changes
+        self._selector = selector
+        self._masks = list(masks)
+        self._normalizer = None
+        # Average cost of a check: bytes received and CPU seconds spent normalizing the body (None until the first check)
+        self._fetch_bytes = fetch_bytes
+        self._fetch_cpu = fetch_cpu
+
+    def get_url(self):
+        return self._url
+
+    def get_kind(self):
+        return self._kind
+
+    def is_feed(self) -> bool:
+        return self._kind == self.FEED
+
+    def get_task_name(self):
+        return self._task_name
+
+    def set_task_name(self, task_name):
+        self._task_name = task_name
+
+    def get_digest(self):
+        return self._digest
+
+    def get_length(self):
+        return self._length
+
+    def set_digest(self, digest, length):
+        self._digest = digest
+        self._length = length
+
+    def get_etag(self):
+        return self._etag
+
+    def get_last_modified(self):
+        return self._last_modified
+
+    def set_validators(self, etag, last_modified):
+        self._etag = etag
+        self._last_modified = last_modified
+
+    def get_interval(self):
+        return self._interval
+
+    def get_checks(self):
+        return self._checks
+
+    def get_changes(self):
+        return self._changes
+
+    def get_last_change(self):
+        return self._last_change
+
+    # Method to return the arguments rebuilding this monitor, used to hand it over to another process
+    def get_state(self) -> tuple:
+        return (self._url, self._interval, self._digest, self._length, self._etag, self._last_modified,
+                self._checks, self._changes, self._last_change, self._selector, self._masks, self._fetch_bytes, self._fetch_cpu, self._kind)
+
+    def get_selector(self):
+        return self._selector
+
+    def get_masks(self):
+        return self._masks
+
+    # Method to return the extraction pipeline of the URL, built on first use
+    def get_normalizer(self):
+        if self._normalizer is None:
+            self._normalizer = self._build_normalizer(self._selector, self._masks)
+        return self._normalizer
+
+    # Private method to build the extraction pipeline of the URL: a feed is reduced to its entries, the region and masks
+    # then apply to the pages it lists
+    def _build_normalizer(self, selector, masks):
+        if self.is_feed():
+            return FeedNormalizer(selector, masks)
+        return Normalizer(selector, masks)
+
+    # Method to change the extraction pipeline: the digests computed so far are not comparable anymore,
+    # so the next check downloads the whole page again and only sets a new baseline
+    def set_pipeline(self, selector, masks):
+        normalizer = self._build_normalizer(selector, masks)  # Raises ValueError or re.error before anything is changed
+        self._selector = selector
+        self._masks = list(masks)
+        self._normalizer = normalizer
+        self._digest = None
+        self._length = 0
+        self._etag = None
+        self._last_modified = None
+
+    # Method to record the outcome of a successful check and adapt the polling interval within the given bounds:
+    # pages that rarely change are polled exponentially less often, pages that change are polled sooner again
+    def record_check(self, changed, min_interval, max_interval):
+        self._checks += 1
+        if changed:
+            self._changes += 1
+            self._last_change = time.time()
+            self._interval *= self.TIGHTEN
+        else:
+            self._interval *= self.BACKOFF
+        self._interval = min(max(self._interval, min_interval), max_interval)
+
+    def get_fetch_bytes(self):
+        return self._fetch_bytes
+
+    def get_fetch_cpu(self):
+        return self._fetch_cpu
+
+    # Method to record the cost of a check in the moving averages of the bytes received and CPU seconds spent normalizing
+    def record_cost(self, size, cpu):
+        if self._fetch_bytes is None:
+            self._fetch_bytes, self._fetch_cpu = size, cpu
+        else:
+            self._fetch_bytes += self.COST_SMOOTHING * (size - self._fetch_bytes)
+            self._fetch_cpu += self.COST_SMOOTHING * (cpu - self._fetch_cpu)
+
+    # Method to update the polling interval and average cost measured by the fetch worker process checking the URL
+    def set_usage(self, interval, fetch_bytes, fetch_cpu):
+        self._interval = interval
+        self._fetch_bytes = fetch_bytes
+        self._fetch_cpu = fetch_cpu
+
+    # Method to estimate the requests sent during the first hour of a URL checked from the given interval and never changing,
+    # the interval backing off after each check
+    @classmethod
+    def estimate_first_hour(cls, interval) -> int:
+        requests, elapsed = 0, 0.0
+        while elapsed < 3600:
+            requests += 1
+            elapsed += interval
+            interval *= cls.BACKOFF
+        return requests
+
+    # Method to estimate the hourly cost of the URL at its current polling interval, as (requests, bytes, CPU seconds)
+    # A URL whose cost was never measured is still in its first hour, its interval backing off from the initial one
+    def get_hourly_cost(self) -> tuple:
+        requests = self.estimate_first_hour(self._interval) if self._fetch_bytes is None else 3600 / self._interval
+        return requests, requests * (self._fetch_bytes or 0), requests * (self._fetch_cpu or 0.0)
+
+    def get_failures(self):
+        return self._failures
+
+    def clear_failures(self):
+        self._failures = 0
+
+    def record_failure(self):
+        self._failures += 1
+
+    # Method to compute the delay before retrying a URL that keeps failing, doubling it at every failure
+    def get_retry_interval(self, max_interval) -> float:
+        return min(self._interval * 2 ** (self._failures - 1), max_interval)
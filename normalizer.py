@@ -0,0 +1,278 @@
+from html.parser import HTMLParser
+import codecs
+import re
+
+try:
+    from re import _parser as sre_parse  # The parser of regular expressions moved in Python 3.11
+except ImportError:
+    import sre_parse
+
+
+class Selector:
+    # Regular expressions of the supported CSS selectors (type, #id, .class and [attribute=value] separated by descendant combinators)
+    # and XPath expressions (//tag[@attribute='value'] steps)
+    CSS_PART = re.compile(r"""(?P<tag>\*|[\w-]+)|\#(?P<id>[\w-]+)|\.(?P<cls>[\w-]+)|\[(?P<attr>[\w-]+)(?:=(?P<value>"[^"]*"|'[^']*'|[^\]]*))?\]""")
+    XPATH_STEP = re.compile(r"""//(?P<tag>\*|[\w-]+)(?P<predicates>(?:\[@[\w-]+=(?:"[^"]*"|'[^']*')\])*)""")
+    XPATH_PREDICATE = re.compile(r"""\[@(?P<attr>[\w-]+)=(?P<value>"[^"]*"|'[^']*')\]""")
+
+    # Initialize a selector from its compound parts, each a (tag, classes, attributes) tuple where an attribute value of None only requires its presence
+    def __init__(self, text, parts):
+        self._text = text
+        self._parts = parts
+
+    def get_text(self):
+        return self._text
+
+    def get_parts(self):
+        return self._parts
+
+    # Method to parse a CSS selector, or an XPath expression when the text starts with "/", raising ValueError if it is not supported
+    @staticmethod
+    def parse(text):
+        text = text.strip()
+        if text.startswith("/"):
+            return Selector(text, Selector._parse_xpath(text))
+        parts = [Selector._parse_compound(compound) for compound in text.replace(">", " ").split()]
+        if not parts:
+            raise ValueError("The selector is empty.")
+        return Selector(text, parts)
+
+    # Private method to parse a compound CSS selector such as div#main.content[role=main]
+    @staticmethod
+    def _parse_compound(compound) -> tuple:
+        tag, classes, attributes = None, set(), {}
+        position = 0
+        while position < len(compound):
+            match = Selector.CSS_PART.match(compound, position)
+            if match is None or (match.group("tag") and position > 0):
+                raise ValueError(f"Unsupported selector: {compound}")
+            if match.group("tag") and match.group("tag") != "*":
+                tag = match.group("tag").lower()
+            elif match.group("id"):
+                attributes["id"] = match.group("id")
+            elif match.group("cls"):
+                classes.add(match.group("cls"))
+            elif match.group("attr"):
+                value = match.group("value")
+                attributes[match.group("attr").lower()] = value.strip("\"'") if value is not None else None
+            position = match.end()
+        return tag, classes, attributes
+
+    # Private method to parse an XPath expression made of //tag[@attribute='value'] steps
+    @staticmethod
+    def _parse_xpath(text) -> list:
+        parts = []
+        position = 0
+        while position < len(text):
+            match = Selector.XPATH_STEP.match(text, position)
+            if match is None:
+                raise ValueError(f"Unsupported XPath expression: {text}")
+            tag = None if match.group("tag") == "*" else match.group("tag").lower()
+            attributes = {predicate.group("attr").lower(): predicate.group("value")[1:-1]
+                          for predicate in Selector.XPATH_PREDICATE.finditer(match.group("predicates"))}
+            parts.append((tag, set(), attributes))
+            position = match.end()
+        return parts
+
+    # Method to check whether an element matches the compound part at the given index
+    def matches(self, index, tag, attrs) -> bool:
+        part_tag, classes, attributes = self._parts[index]
+        if part_tag is not None and part_tag != tag:
+            return False
+        values = dict(attrs)
+        if classes and not classes.issubset((values.get("class") or "").split()):
+            return False
+        return all(name in values and (value is None or values[name] == value) for name, value in attributes.items())
+
+
+class TextExtractor(HTMLParser):
+    # Elements whose content is never text shown to the reader
+    SKIPPED_TAGS = {"script", "style", "noscript", "template"}
+    # Elements without content, which are never closed
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+    # Elements starting a new line of text
+    BLOCK_TAGS = {"address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "fieldset", "figcaption", "figure", "footer",
+                  "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table",
+                  "td", "th", "title", "tr", "ul"}
+
+    # Initialize the extractor of the text of a page, keeping only the region matching the selector if one is given
+    def __init__(self, selector: Selector = None):
+        super().__init__(convert_charrefs=True)
+        self._selector = selector
+        self._depth = len(selector.get_parts()) if selector is not None else 0  # Number of selector parts to match to be in the region
+        self._stack = []  # Open elements, as (tag, number of selector parts matched by the element and its ancestors)
+        self._skipping = 0  # Number of open elements whose content is skipped
+        self._words = []  # Text of the current line
+        self._lines = []  # Completed lines not taken yet
+
+    # Method to return and forget the lines completed so far
+    def take_lines(self) -> list:
+        lines, self._lines = self._lines, []
+        return lines
+
+    # Method to complete the current line
+    def end_line(self):
+        text = " ".join("".join(self._words).split())
+        self._words = []
+        if text:
+            self._lines.append(text)
+
+    # Private method to return the number of selector parts matched by the innermost open element
+    def _matched(self) -> int:
+        return self._stack[-1][1] if self._stack else 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.end_line()
+        if tag in self.VOID_TAGS:
+            return
+        matched = self._matched()
+        if self._selector is not None and matched < self._depth and self._selector.matches(matched, tag, attrs):
+            matched += 1
+        self._stack.append((tag, matched))
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.end_line()
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self.end_line()
+        # Close the element and the elements left open inside it, ignoring end tags without a start tag
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                for closed, _ in self._stack[i:]:
+                    if closed in self.SKIPPED_TAGS:
+                        self._skipping -= 1
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        if self._skipping == 0 and self._matched() >= self._depth:
+            self._words.append(data)
+
+
+class NormalizerStream:
+    # Maximum length of the text searched by the masks at once, longer lines are masked piece by piece
+    MAX_MASKED_LENGTH = 1000
+
+    # Initialize the normalization of one body: HTML is reduced to its text, other text is kept line by line, anything else is kept as is
+    def __init__(self, content_type, encoding, selector, masks):
+        self._masks = masks
+        content_type = (content_type or "").lower()
+        self._html = "html" in content_type
+        self._text = self._html or content_type.startswith("text/") or "json" in content_type or "xml" in content_type
+        self._extractor = TextExtractor(selector) if self._html else None
+        self._tail = ""  # Incomplete last line of a text body
+        try:
+            self._decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+        except LookupError:
+            self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    # Method to return the encoding of the normalized body
+    def get_encoding(self, encoding):
+        return "utf-8" if self._text else encoding
+
+    # Method to normalize the next chunk of the body, returning the normalized bytes completed so far
+    def feed(self, chunk) -> bytes:
+        if not self._text:
+            return chunk
+        text = self._decoder.decode(chunk)
+        if self._extractor is not None:
+            self._extractor.feed(text)
+            return self._output(self._extractor.take_lines())
+        lines = (self._tail + text).split("\n")
+        self._tail = lines.pop()
+        return self._output(lines)
+
+    # Method to complete the normalization, returning the remaining normalized bytes
+    def close(self) -> bytes:
+        if not self._text:
+            return b""
+        text = self._decoder.decode(b"", final=True)
+        if self._extractor is not None:
+            self._extractor.feed(text)
+            self._extractor.close()
+            self._extractor.end_line()
+            return self._output(self._extractor.take_lines())
+        return self._output([self._tail + text])
+
+    # Private method to mask the volatile tokens of complete lines and encode them
+    def _output(self, lines) -> bytes:
+        if not lines:
+            return b""
+        text = ""
+        for line in lines:
+            if self._masks:
+                line = "".join(self._mask(line[i:i + self.MAX_MASKED_LENGTH]) for i in range(0, len(line), self.MAX_MASKED_LENGTH))
+            text += line.rstrip("\r") + "\n"
+        return text.encode()
+
+    # Private method to replace the volatile tokens of a piece of text
+    def _mask(self, text) -> str:
+        for mask in self._masks:
+            text = mask.sub("*", text)
+        return text
+
+
+class Normalizer:
+    # Maximum number of unbounded repetitions (such as + or *) in a mask
+    MAX_UNBOUNDED_REPEATS = 2
+    # Operators of the parsed regular expressions for repetitions, and for back-references which are rejected
+    REPEATS = {"MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"}
+    REJECTED = {"GROUPREF", "GROUPREF_EXISTS", "GROUPREF_IGNORE", "GROUPREF_LOC_IGNORE", "GROUPREF_UNI_IGNORE"}
+
+    # Initialize the extraction pipeline of a URL: an optional CSS selector or XPath region and regular expressions masking volatile tokens
+    def __init__(self, selector=None, masks=()):
+        self._selector = Selector.parse(selector) if selector else None
+        for mask in masks:
+            self.check_mask(mask)
+        self._masks = [re.compile(mask) for mask in masks]
+
+    def get_selector(self):
+        return self._selector
+
+    def get_masks(self):
+        return self._masks
+
+    # Method to check that a mask cannot backtrack catastrophically, raising ValueError (or re.error if it is invalid) otherwise:
+    # a repetition may not contain alternatives, variable repetitions or back-references, and few repetitions may be unbounded
+    @staticmethod
+    def check_mask(mask):
+        if Normalizer._count_unbounded(sre_parse.parse(mask), False) > Normalizer.MAX_UNBOUNDED_REPEATS:
+            raise ValueError(f"A mask can contain at most {Normalizer.MAX_UNBOUNDED_REPEATS} unbounded repetitions (+, *, {{n,}}).")
+
+    # Private method to count the unbounded repetitions of a parsed regular expression, rejecting the constructs that can backtrack
+    # catastrophically; repeated tells whether the items are inside a variable repetition
+    @staticmethod
+    def _count_unbounded(items, repeated) -> int:
+        count = 0
+        for op, av in items:
+            name = str(op)
+            if name in Normalizer.REJECTED:
+                raise ValueError("Back-references are not allowed in masks.")
+            if name in Normalizer.REPEATS:
+                low, high, subpattern = av
+                variable = low != high
+                if variable and repeated:
+                    raise ValueError("Nested repetitions such as (a+)+ are not allowed in masks.")
+                count += high == sre_parse.MAXREPEAT
+                count += Normalizer._count_unbounded(subpattern, repeated or variable)
+            elif name == "BRANCH":
+                if repeated:
+                    raise ValueError("Repeated alternatives such as (a|b)+ are not allowed in masks.")
+                count += sum(Normalizer._count_unbounded(branch, repeated) for branch in av[1])
+            elif name == "SUBPATTERN":
+                count += Normalizer._count_unbounded(av[-1], repeated)
+            elif name in ("ASSERT", "ASSERT_NOT"):
+                count += Normalizer._count_unbounded(av[1], repeated)
+            elif name == "ATOMIC_GROUP":
+                count += Normalizer._count_unbounded(av, repeated)
+        return count
+
+    # Method to start the normalization of a body with the given content type and encoding
+    # The body is decoded by the HTTP client, so its size is already limited to max_size by the fetcher
+    def stream(self, content_type, encoding, max_size) -> NormalizerStream:
+        return NormalizerStream(content_type, encoding, self._selector, self._masks)
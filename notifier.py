@@ -0,0 +1,159 @@
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+from telegram import Bot
+import logging
+import asyncio
+import heapq
+import time
+
+
+class Notifier:
+    # Telegram rejects messages longer than this many characters
+    MAX_MESSAGE_LENGTH = 4096
+
+    # Initialize the outbox: messages are buffered per chat and delivered by a few sender tasks
+    # respecting a global rate (messages per second) and a minimum interval between two messages to the same chat
+    def __init__(self, global_rate, chat_interval, senders, max_retries):
+        self._global_rate = global_rate
+        self._chat_interval = chat_interval
+        self._senders = senders
+        self._max_retries = max_retries
+        self._bot = None
+        self._pending = {}  # Map of chat ID to the list of texts waiting to be sent
+        self._retries = {}  # Map of chat ID to the number of failed attempts of its pending texts
+        self._last_sent = {}  # Map of chat ID to the monotonic time of its last message
+        self._heap = []  # Heap of (ready time, chat ID) of chats with pending texts
+        self._next_slot = 0.0  # Monotonic time of the next send allowed by the global rate
+        self._wakeup = None
+        self._tasks = []
+
+    def get_global_rate(self):
+        return self._global_rate
+
+    def get_chat_interval(self):
+        return self._chat_interval
+
+    def get_senders(self):
+        return self._senders
+
+    def get_max_retries(self):
+        return self._max_retries
+
+    # Method to return the number of texts waiting to be delivered
+    def get_queue_depth(self) -> int:
+        return sum(len(texts) for texts in self._pending.values())
+
+    # Method to start the sender tasks delivering the messages through the given bot
+    def start(self, bot: Bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        for i in range(self.get_senders()):
+            self._tasks.append(asyncio.create_task(self._send_loop(), name=f"Notifier-sender-{i + 1}"))
+
+    # Method to stop the senders, giving them up to timeout seconds to deliver what is still pending
+    async def stop(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._pending:
+            logging.warning(f"{self.get_queue_depth()} notifications dropped on shutdown.")
+
+    # Method to queue a message for a chat without waiting for its delivery
+    # Texts queued for the same chat before it is its turn are merged into a single digest message
+    def notify(self, chat_id, text):
+        texts = self._pending.get(chat_id)
+        if texts is not None:
+            texts.append(text)
+            return
+        self._pending[chat_id] = [text]
+        ready = self._last_sent.get(chat_id, 0.0) + self.get_chat_interval()
+        self._push(chat_id, ready)
+
+    # Private method to make a chat with pending texts ready at the given monotonic time
+    def _push(self, chat_id, ready):
+        heapq.heappush(self._heap, (ready, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # Private method to merge as many pending texts of a chat as fit into one message
+    def _take_digest(self, chat_id) -> tuple:
+        texts = self._pending[chat_id]
+        digest = texts[0][:self.MAX_MESSAGE_LENGTH]
+        count = 1
+        while count < len(texts) and len(digest) + 1 + len(texts[count]) <= self.MAX_MESSAGE_LENGTH:
+            digest += "\n" + texts[count]
+            count += 1
+        return digest, count
+
+    # Private method to wait for the next slot allowed by the global rate
+    async def _acquire_slot(self):
+        now = time.monotonic()
+        slot = max(self._next_slot, now)
+        self._next_slot = slot + 1 / self.get_global_rate()
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    # Private method run by each sender: deliver the digest of the chat that is ready first
+    async def _send_loop(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            ready, chat_id = self._heap[0]
+            delay = ready - time.monotonic()
+            if delay > 0:
+                # wait, unlike wait_for, lets a cancellation through even if the wakeup is set at the same time
+                wakeup = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait([wakeup], timeout=delay)
+                finally:
+                    wakeup.cancel()
+                continue
+            heapq.heappop(self._heap)
+            await self._acquire_slot()
+            await self._send(chat_id)
+
+    # Private method to send one digest message to a chat, requeueing it if Telegram asks to slow down
+    async def _send(self, chat_id):
+        text, count = self._take_digest(chat_id)
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
+        except RetryAfter as e:
+            # Flood control: pause every sender and retry this chat once the requested time has elapsed
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logging.warning(f"Flood control exceeded, retrying in {retry_after} seconds.")
+            self._next_slot = max(self._next_slot, time.monotonic() + retry_after)
+            self._push(chat_id, time.monotonic() + retry_after)
+            return
+        except (Forbidden, BadRequest) as e:
+            # The user has blocked the bot or the chat does not exist: retrying cannot help
+            logging.error(f"Dropping notifications for chat {chat_id}: {e}")
+            self._drop(chat_id, len(self._pending[chat_id]))
+            return
+        except TelegramError as e:
+            retries = self._retries.get(chat_id, 0) + 1
+            if retries > self.get_max_retries():
+                logging.error(f"Dropping notification for chat {chat_id} after {retries - 1} retries: {e}")
+                self._drop(chat_id, count)
+            else:
+                # Back off exponentially before trying the same digest again
+                logging.warning(f"Error notifying chat {chat_id}, retry {retries}: {e}")
+                self._retries[chat_id] = retries
+                self._push(chat_id, time.monotonic() + self.get_chat_interval() * 2 ** retries)
+            return
+        self._last_sent[chat_id] = time.monotonic()
+        self._drop(chat_id, count)
+
+    # Private method to discard the first count pending texts of a chat, requeueing the chat if texts remain
+    def _drop(self, chat_id, count):
+        self._retries.pop(chat_id, None)
+        texts = self._pending[chat_id]
+        del texts[:count]
+        if texts:
+            self._push(chat_id, time.monotonic() + self.get_chat_interval())
+        else:
+            del self._pending[chat_id]
@@ -3,24 +3,113 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from httpx import RequestError, HTTPStatusError, AsyncClient, Response
 from urllib.parse import urlparse, urljoin
 from dotenv import load_dotenv
-from database import Database
+from database import Database, AsyncDatabase
 from utility import Utility
+from scheduler import Scheduler
+from fetcher import Fetcher
+from monitor import Monitor
+from feed import FeedNormalizer
+from registry import MonitorRegistry
+from notifier import Notifier
+from circuitbreaker import CircuitBreaker
+from quota import Quota
+from latency import LatencyTracker
+from snapshot import Snapshot
+from metrics import Metrics
+from sharding import ShardPool
 from command import Command
+from updateprocessor import ChatUpdateProcessor
 import validators
+import hashlib
+import functools
 import logging
+import json
 import asyncio
 import signal
+import time
 import sys
 import os
 
 
 class WebMonitoringBot:
-    # Set the time interval to check whether URLs have changed (in seconds)
+    # Set the initial time interval to check whether URLs have changed (in seconds)
     TIME = 60
-    # Set the maximum number of tasks per user
-    MAX_TASKS_PER_USER = 5
+    # Set the bounds (in seconds) within which the interval of each URL adapts to how often it changes
+    MIN_INTERVAL = 60
+    MAX_INTERVAL = 6 * 60 * 60
+    # Set the maximum number of tasks per user, whatever they cost
+    MAX_TASKS_PER_USER = 1000
+    # Set the hourly fetch budget of each user, the cost of a URL being shared by its subscribers: requests sent,
+    # bytes received and CPU seconds spent normalizing bodies, and how often (in seconds) users over budget are throttled
+    # The requests fit MAX_TASKS_PER_USER new URLs, each checked 9 times during its first hour from TIME
+    USER_REQUESTS_PER_HOUR = 10000
+    USER_BYTES_PER_HOUR = 512 * 1024 * 1024
+    USER_CPU_PER_HOUR = 120.0
+    QUOTA_REFRESH_INTERVAL = 60
+    # Set the number of fetch workers running checks concurrently
+    FETCH_WORKERS = 20
+    # Set the random jitter applied to each interval (as a fraction of it) to spread the checks over time
+    JITTER = 0.1
+    # Set the time window (in seconds) over which overdue checks are spread on startup
+    STARTUP_SPREAD = 60
+    # Set how often (in seconds) buffered database writes are committed, and the batch size forcing an early commit
+    DB_FLUSH_INTERVAL = 1.0
+    DB_MAX_BATCH = 500
+    # Set the global number of notifications sent per second and the minimum interval (in seconds) between two messages to the same chat
+    NOTIFY_RATE = 25
+    NOTIFY_CHAT_INTERVAL = 1.0
+    # Set the number of tasks delivering notifications and how many times a failed notification is retried
+    NOTIFY_SENDERS = 4
+    NOTIFY_MAX_RETRIES = 3
+    # Set the interface of the local metrics endpoint and how often (in seconds) the event loop lag is sampled
+    METRICS_HOST = "127.0.0.1"
+    LOOP_LAG_INTERVAL = 0.5
+    # Set the size of the shared HTTP connection pool
+    MAX_CONNECTIONS = 100
+    MAX_KEEPALIVE_CONNECTIONS = 50
+    # Set the maximum number of concurrent requests sent to the same host
+    MAX_CONNECTIONS_PER_HOST = 4
+    # Set the consecutive failures opening the circuit of a host, and the bounds (in seconds) of its backoff
+    BREAKER_THRESHOLD = 5
+    BREAKER_BASE_DELAY = 60
+    BREAKER_MAX_DELAY = 60 * 60
+    # Set the delay (in seconds) before retrying the URLs of a host whose probe request is in flight
+    BREAKER_PROBE_WAIT = 30
+    # Set the maximum size of a downloaded page (in bytes)
+    MAX_BODY_SIZE = 5 * 1024 * 1024
+    # Set the timeouts (in seconds) of a fetch: to connect, for each read, and for the whole fetch including its retries
+    CONNECT_TIMEOUT = 3.0
+    READ_TIMEOUT = 10.0
+    TOTAL_TIMEOUT = 20.0
+    # Set the recent latencies kept for each host, how many are needed to estimate their percentiles, and the percentile
+    # after which a hedged copy of a request is sent (None disables hedging)
+    LATENCY_WINDOW = 100
+    LATENCY_MIN_SAMPLES = 20
+    HEDGE_PERCENTILE = 0.95
+    # Set how many times a request whose connection fails or is dropped before the response is sent again
+    FETCH_RETRIES = 1
+    # Set the compression level of the snapshots and how many snapshots are kept for each URL
+    SNAPSHOT_LEVEL = 3
+    SNAPSHOT_RETENTION = 5
+    # Set the maximum size (in bytes) of the pages compared line by line, and the maximum length of the diff sent to the users
+    DIFF_MAX_SIZE = 512 * 1024
+    DIFF_MAX_CHARS = 1500
+    # Set the maximum number of new or changed pages of a sitemap or feed fetched at each check, the others wait for the next checks
+    FEED_MAX_PAGES = 20
+    # Set the points of each fetch worker process on the hash ring, and how often (in seconds) the workers receive the polling interval bounds
+    SHARD_REPLICAS = 100
+    SHARD_SYNC_INTERVAL = 60
+    # Set the number of updates handled concurrently (the updates of a same chat are handled in order, as conversations expect),
+    # and the number of connections Telegram may open to deliver them in webhook mode
+    CONCURRENT_UPDATES = 32
+    WEBHOOK_MAX_CONNECTIONS = 40
+    # Set the time window (in seconds) over which the first checks of URLs followed at once are spread, and the maximum size of an imported file (in bytes)
+    FOLLOW_SPREAD = 60
+    MAX_IMPORT_SIZE = 1024 * 1024
+    # Set the number of recently active users whose registration is cached
+    USER_CACHE_SIZE = 10000
 
-    def __init__(self):
+    def __init__(self, database="miodatabase.db", shard=None):
         self._util = Utility()
         # Load .env (environment) and override system's variables
         load_dotenv(override=True)
@@ -28,9 +117,52 @@ class WebMonitoringBot:
         self._TOKEN_API = self.get_utility().load_token_api()
         self._STATE_REQUEST_URL = self.get_utility().load_state_request_url()
         self._ALLOWED_IDS = self.get_utility().load_allowed_ids()
+        self._ADMIN_IDS = self.get_utility().load_admin_ids()
+        self._METRICS_PORT = self.get_utility().load_metrics_port()
+        self._FETCH_PROCESSES = self.get_utility().load_fetch_processes()
+        self._WEBHOOK_URL = self.get_utility().load_webhook_url()
+        self._WEBHOOK_LISTEN = self.get_utility().load_webhook_listen()
+        self._WEBHOOK_PORT = self.get_utility().load_webhook_port()
+        self._WEBHOOK_SECRET = self.get_utility().load_webhook_secret()
+        self._WEBHOOK_CERT, self._WEBHOOK_KEY = self.get_utility().load_webhook_certificate()
+        self._TELEGRAM_BASE_URL = self.get_utility().load_telegram_base_url()
+        # Initialize the metrics of the monitoring loop
+        self._metrics = Metrics(self.LOOP_LAG_INTERVAL)
         # Initialize the database connection
-        self._db = Database("miodatabase.db")
-        self._command_handler = Command(self._db, self.MAX_TASKS_PER_USER, self._STATE_REQUEST_URL)
+        self._db = AsyncDatabase(Database(database), self.DB_FLUSH_INTERVAL, self.DB_MAX_BATCH, self._metrics)
+        # Initialize the HTTP client shared by every check
+        self._fetcher = Fetcher(self.MAX_CONNECTIONS, self.MAX_KEEPALIVE_CONNECTIONS, self.MAX_CONNECTIONS_PER_HOST, self.MAX_BODY_SIZE,
+                                CircuitBreaker(self.BREAKER_THRESHOLD, self.BREAKER_BASE_DELAY, self.BREAKER_MAX_DELAY, self.BREAKER_PROBE_WAIT), self.SNAPSHOT_LEVEL, self._metrics,
+                                LatencyTracker(self.LATENCY_WINDOW, self.LATENCY_MIN_SAMPLES), self.CONNECT_TIMEOUT, self.READ_TIMEOUT, self.TOTAL_TIMEOUT,
+                                self.HEDGE_PERCENTILE, self.FETCH_RETRIES)
+        # Initialize the scheduler that runs every URL check on a bounded pool of workers
+        self._scheduler = Scheduler(self.TIME, self.FETCH_WORKERS, self.JITTER, self._metrics)
+        # Initialize the outbox delivering change notifications
+        self._notifier = Notifier(self.NOTIFY_RATE, self.NOTIFY_CHAT_INTERVAL, self.NOTIFY_SENDERS, self.NOTIFY_MAX_RETRIES)
+        # Initialize the index of monitors and subscriptions by user and by URL
+        self._registry = MonitorRegistry()
+        # Initialize the fetch budget of each user, a user over budget can throttle their URLs down to the maximum interval
+        self._quota = Quota(self.USER_REQUESTS_PER_HOUR, self.USER_BYTES_PER_HOUR, self.USER_CPU_PER_HOUR, self.QUOTA_REFRESH_INTERVAL,
+                            self.MAX_INTERVAL / self.MIN_INTERVAL)
+        # Link to the main process when this bot runs in a fetch worker process
+        self._shard = shard
+        # Initialize the pool of fetch worker processes, unless the URLs are checked in this process
+        self._shards = None
+        if shard is None and self._FETCH_PROCESSES > 1:
+            self._shards = ShardPool(self._FETCH_PROCESSES, self.SHARD_REPLICAS, self.SHARD_SYNC_INTERVAL, type(self), database,
+                                     self.get_bounds, self.notify_change, self.update_usage, self._metrics.merge,
+                                     self.load_monitor_states)
+            # The fetches are recorded by the workers, their metrics are merged whenever /stats or /metrics is read
+            self._metrics.set_collector(self._shards.collect_metrics)
+        # Application running the bot, set once the event loop is running
+        self._app = None
+        self._command_handler = Command(self._db, self._shards or self._scheduler, self._registry, self.MAX_TASKS_PER_USER, self._STATE_REQUEST_URL,
+                                        self.MIN_INTERVAL, self.MAX_INTERVAL, self._metrics, self.USER_CACHE_SIZE, self._quota,
+                                        self._ADMIN_IDS)
+        # Expose the size of the queues and indexes of the monitoring loop
+        self._metrics.add_gauge("peppy_notification_queue_depth", "Notifications waiting to be delivered.", self._notifier.get_queue_depth)
+        self._metrics.add_gauge("peppy_db_pending_writes", "Database writes waiting to be committed.", self._db.get_pending)
+        self._metrics.add_gauge("peppy_scheduled_monitors", "Monitors in the scheduler.", (self._shards or self._scheduler).count)
 
     def get_command_handler(self):
         return self._command_handler
@@ -38,12 +170,39 @@ class WebMonitoringBot:
     def get_db(self):
         return self._db
 
+    def get_scheduler(self):
+        return self._scheduler
+
+    def get_fetcher(self):
+        return self._fetcher
+
+    def get_registry(self):
+        return self._registry
+
+    def get_shards(self):
+        return self._shards
+
+    def get_quota(self):
+        return self._quota
+
+    def get_notifier(self):
+        return self._notifier
+
+    def get_app(self):
+        return self._app
+
     def get_state_request_url(self):
         return self._STATE_REQUEST_URL
 
     def get_allowed_ids(self):
         return self._ALLOWED_IDS
 
+    def get_admin_ids(self):
+        return self._ADMIN_IDS
+
+    def get_metrics(self):
+        return self._metrics
+
     def get_utility(self):
         return self._util
 
@@ -52,17 +211,18 @@ class WebMonitoringBot:
         # Log the start of the cleanup process
         logging.info("Performing cleanup before shutdown...")
 
-        # Retrieve all task names from the database
-        task_name_list = self.get_db().get_all_tasks()
-        # Identify tasks that need to be canceled based on their names
-        tasks_to_cancel = [task for task in asyncio.all_tasks() if task.get_name() in task_name_list]
-        for task in tasks_to_cancel:
-            # Cancel each identified task
-            task.cancel()
-            # Log the cancellation request for each task
-            logging.info(f"{task.get_name()} requested cancellation.")
-
-        await asyncio.gather(*tasks_to_cancel, return_exceptions=False)
+        # Stop the dispatcher and the fetch workers of the scheduler, or the fetch worker processes
+        await self.get_scheduler().stop()
+        if self.get_shards() is not None:
+            await self.get_shards().stop()
+        # Deliver the notifications still in the outbox
+        await self.get_notifier().stop(timeout=5.0)
+        # Close the shared HTTP client and its pooled connections
+        await self.get_fetcher().close()
+        # Commit the buffered database writes
+        await self.get_db().close()
+        # Stop the event loop lag probe and the metrics endpoint
+        await self.get_metrics().stop()
         # Log the completion of the cleanup process
         logging.info("Cleanup completed.")
 
@@ -74,28 +234,251 @@ class WebMonitoringBot:
         sys.exit(0)  # Exit the application gracefully
 
 
-    async def track_url_changes(self, update: Update, url) -> None:
-        prev_content = ""
+    # Hook run by the application once the event loop is running
+    async def post_init(self, app: Application) -> None:
+        self._app = app
+        await self.start(app.bot)
+
+    # Start the monitoring loop, delivering the change notifications through the given bot
+    async def start(self, bot) -> None:
+        await self.get_metrics().start(self.METRICS_HOST, self._METRICS_PORT)
+        self.get_db().start()
+        if self.get_shards() is not None:
+            # The worker processes must be running before the monitors are handed over to them
+            await self.get_shards().start()
+        await self.restore_monitors()
+        self.get_notifier().start(bot)
+        if self.get_shards() is None:
+            self.get_scheduler().start()
+
+    # Hook run by the application after it has been shut down
+    async def post_shutdown(self, app: Application) -> None:
+        await self.cleanup()
+
+    # Build a monitor from its state saved in the database
+    def build_monitor(self, row) -> Monitor:
+        (url, digest, length, etag, last_modified, next_check, interval, checks, changes, last_change, selector, masks,
+         fetch_bytes, fetch_cpu, kind) = row
+        return Monitor(url, interval or self.TIME, digest, length, etag, last_modified, checks, changes, last_change,
+                       selector, json.loads(masks) if masks else (), fetch_bytes, fetch_cpu, kind)
+
+    # Retrieve the saved state of the monitors of the given URLs and the time left before their next check, as a map of URL
+    # to (state, delay), so that a restarted fetch worker process resumes their checks
+    async def load_monitor_states(self, urls) -> dict:
+        # The monitors added by this process must be saved before they are read back
+        await self.get_db().flush()
+        now = time.time()
+        urls = set(urls)
+        states = {}
+        for row in await self.get_db().get_monitors():
+            if row[0] in urls:
+                states[row[0]] = (self.build_monitor(row).get_state(), max(row[5] - now, 0.0))
+        # A monitor not saved yet starts again from the state known to this process
+        for url in urls - states.keys():
+            monitor = self.get_registry().get_monitor(url)
+            if monitor is not None:
+                states[url] = (monitor.get_state(), 0.0)
+        return states
+
+    # Rebuild the monitors saved in the database, so that a restart resumes monitoring where it stopped
+    async def restore_monitors(self) -> None:
+        now = time.time()
+        monitors = await self.get_db().get_monitors()
+        overdue = [row for row in monitors if row[5] <= now]
+        restored = []
+        for row in monitors:
+            monitor = self.build_monitor(row)
+            self.get_registry().add_monitor(monitor)
+            restored.append((monitor, row[5]))
+        # Subscriptions are restored before the monitors are scheduled, so that the bounds of every URL are known
+        for uid, url in await self.get_db().get_all_links():
+            self.get_registry().subscribe(uid, url)
+        for uid, min_interval, max_interval in await self.get_db().get_all_user_bounds():
+            self.get_registry().set_user_bounds(uid, min_interval, max_interval)
+        tasks = []
+        # Monitors are ordered by next check, so the overdue ones come first
+        for i, (monitor, next_check) in enumerate(restored):
+            if next_check > now:
+                delay = next_check - now
+            else:
+                # Spread overdue checks evenly over the startup window so that the first poll wave does not saturate the box
+                delay = i * self.STARTUP_SPREAD / len(overdue)
+            tasks.append((self.schedule_monitor(monitor, delay), monitor.get_url()))
+        # Save the new task names of all monitors in a single transaction
+        await self.get_db().set_tasks(tasks)
+        logging.info(f"{len(tasks)} monitors restored, {len(overdue)} of them overdue.")
+
+    # Schedule the checks of a monitor, in this process or in the fetch worker process owning its URL, returning the name of its job
+    def schedule_monitor(self, monitor: Monitor, delay=0.0) -> str:
+        if self.get_shards() is not None:
+            task_name = self.get_shards().add(monitor, delay)
+        else:
+            task_name = self.get_scheduler().add(functools.partial(self.track_url_changes, monitor), delay)
+        monitor.set_task_name(task_name)
+        return task_name
+
+    # Compute the polling interval bounds of a URL, chosen by its subscribers within the global bounds
+    def get_bounds(self, url) -> tuple:
+        if self._shard is not None:
+            # In a fetch worker process, the bounds are sent by the main process
+            return self._shard.get_bounds(url, self.MIN_INTERVAL, self.MAX_INTERVAL)
+        return self.get_registry().get_bounds(url, self.MIN_INTERVAL, self.MAX_INTERVAL, self.get_quota().get_throttles(self.get_registry()))
+
+    # Update the polling interval and average cost of a check of a URL, measured by the fetch worker process checking it
+    def update_usage(self, url, interval, fetch_bytes, fetch_cpu):
+        monitor = self.get_registry().get_monitor(url)
+        if monitor is not None:
+            monitor.set_usage(interval, fetch_bytes, fetch_cpu)
+
+    # Notify the subscribers of a URL that its content changed
+    def notify_change(self, url, prev_digest, curr_digest, diff):
+        if self._shard is not None:
+            # In a fetch worker process, the change is sent to the main process, which owns the Telegram connection
+            self._shard.send_change(url, prev_digest, curr_digest, diff)
+            return
+        self.get_utility().check_for_changes(prev_digest, curr_digest, url, self.get_notifier(), self.get_registry().get_subscribers(url), diff)
+
+    # Run a single check of the URL, called by the scheduler every time the URL is due
+    # A detected change is sent to every subscriber of the URL, so each unique URL is fetched once per interval
+    async def track_url_changes(self, monitor: Monitor) -> float:
+        normalizer = monitor.get_normalizer()
+        result = await self.get_fetcher().fetch_url_content(monitor.get_url(), monitor.get_etag(), monitor.get_last_modified(), normalizer)
+        if normalizer is not monitor.get_normalizer():
+            # The pipeline changed during the fetch: this digest must not become the baseline of the new pipeline
+            return monitor.get_interval()
+        monitor.set_validators(result.get_etag(), result.get_last_modified())
+        size, cpu = result.get_size(), result.get_cpu()
+        # A 304 reply means the page has not changed since the previous check, and a failed fetch keeps the previous digest
+        if not result.is_failed():
+            monitor.clear_failures()
+            # The first successful fetch only sets the baseline digest
+            baseline = monitor.get_digest() is not None
+            if monitor.is_feed():
+                changed, pages = await self.check_feed_pages(monitor, normalizer, result)
+                # The pages fetched count in the cost of the check of the feed
+                size += sum(page.get_size() for page in pages)
+                cpu += sum(page.get_cpu() for page in pages)
+            else:
+                changed = bool(baseline and result.get_digest() and monitor.get_digest() != result.get_digest())
+                if changed:
+                    diff = await self.compute_diff(monitor, result)
+                    self.notify_change(monitor.get_url(), monitor.get_digest(), result.get_digest(), diff)
+                if result.get_digest() is not None and result.get_digest() != monitor.get_digest():
+                    # Store a snapshot of every new version of the page, the next diff is computed against it
+                    self.get_db().queue_write("insert_snapshot", monitor.get_url(), result.get_digest(), Snapshot.get_codec(), result.get_snapshot(),
+                                              result.get_length(), time.time(), self.SNAPSHOT_RETENTION)
+                    monitor.set_digest(result.get_digest(), result.get_length())
+            if baseline:
+                # Adapt the interval to how often the page changes, within the bounds chosen by its subscribers
+                min_interval, max_interval = self.get_bounds(monitor.get_url())
+                monitor.record_check(changed, min_interval, max_interval)
+            next_interval = monitor.get_interval()
+        elif result.get_retry_after() > 0:
+            # The circuit of the host is open: no request was sent, try again once a probe is allowed
+            next_interval = result.get_retry_after()
+        else:
+            # Back off exponentially on a URL that keeps failing
+            monitor.record_failure()
+            next_interval = monitor.get_retry_interval(self.MAX_INTERVAL)
+        if result.get_retry_after() <= 0:
+            # A request has been sent: its cost counts against the budget of the subscribers
+            monitor.record_cost(size, cpu)
+        # Persist the state of the monitor so that it survives a restart, committed with the other buffered writes
+        self.get_db().queue_write("update_monitor", monitor.get_url(), monitor.get_digest(), monitor.get_length(),
+                                  monitor.get_etag(), monitor.get_last_modified(), time.time() + next_interval,
+                                  monitor.get_interval(), monitor.get_checks(), monitor.get_changes(), monitor.get_last_change(),
+                                  monitor.get_fetch_bytes(), monitor.get_fetch_cpu())
+        # The scheduler runs the next check once this interval has elapsed
+        return next_interval
+
+    # Compute the diff between the latest snapshot of the URL and the body just fetched, or None if it cannot be computed cheaply
+    async def compute_diff(self, monitor: Monitor, result) -> str:
+        if monitor.get_length() > self.DIFF_MAX_SIZE or result.get_length() > self.DIFF_MAX_SIZE:
+            return None
+        snapshot = await self.get_db().get_latest_snapshot(monitor.get_url())
+        if snapshot is None:
+            return None
+        codec, data = snapshot
         try:
-            while True:
-                curr_content = await self.get_utility().fetch_url_content(url)
-                await self.get_utility().check_for_changes(prev_content, curr_content, url, update)
-                prev_content = curr_content
-                await asyncio.sleep(self.TIME)
-        except asyncio.CancelledError:
-            await update.message.reply_text(f"Monitoring of {url} stopped.")
-            logging.info("Task terminated.")
-
-    async def add_monitoring_task(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            # Decompressing and comparing run off the event loop
+            return await asyncio.to_thread(lambda: Snapshot.diff(Snapshot.decompress(codec, data), Snapshot.decompress(Snapshot.get_codec(), result.get_snapshot()),
+                                                                 result.get_encoding(), self.DIFF_MAX_CHARS))
+        except Exception as e:
+            logging.error(f"Error computing the diff of {monitor.get_url()}: {e}")
+            return None
+
+    # Compare the entries of a sitemap or feed with the state saved at its previous check, and fetch only the pages that are new
+    # or whose version changed, at most FEED_MAX_PAGES of them; the subscribers are notified of the new pages and of the pages
+    # whose content changed. Returns whether a page changed, and the results of the page fetches
+    async def check_feed_pages(self, monitor: Monitor, normalizer: FeedNormalizer, result) -> tuple:
+        if result.get_digest() is None or result.get_digest() == monitor.get_digest():
+            # The entries have not changed since every page they list was checked
+            return False, []
+        entries = FeedNormalizer.read_entries(Snapshot.decompress(Snapshot.get_codec(), result.get_snapshot()))
+        snapshot = await self.get_db().get_latest_snapshot(monitor.get_url()) if monitor.get_digest() is not None else None
+        if snapshot is None:
+            # The first check only records the entries, the pages are fetched once their version changes
+            state = {url: (version, "") for url, version in entries.items()}
+            pending = False
+            pages = []
+            new, updated = [], []
+        else:
+            previous = FeedNormalizer.read_state(Snapshot.decompress(*snapshot))
+            candidates = [url for url, version in entries.items() if url not in previous or previous[url][0] != version]
+            fetched = candidates[:self.FEED_MAX_PAGES]
+            pages = await asyncio.gather(*[self.get_fetcher().fetch_url_content(url, normalizer=normalizer.get_page_normalizer()) for url in fetched])
+            if normalizer is not monitor.get_normalizer():
+                # The pipeline changed during the fetches: the next check sets a new baseline
+                return False, pages
+            # The entries that were not fetched, or whose fetch failed, keep their previous state and are fetched at the next checks
+            state = {url: previous[url] for url in entries if url in previous}
+            new, updated = [], []
+            for url, page in zip(fetched, pages):
+                if page.is_failed():
+                    continue
+                if url not in previous:
+                    new.append(url)
+                elif previous[url][1] != page.get_digest():
+                    updated.append(url)
+                state[url] = (entries[url], page.get_digest())
+            pending = any(state.get(url, (None,))[0] != version for url, version in entries.items())
+        data = FeedNormalizer.write_state(state)
+        digest = hashlib.sha256(data).hexdigest()
+        compressor = Snapshot.compressor(self.SNAPSHOT_LEVEL)
+        self.get_db().queue_write("insert_snapshot", monitor.get_url(), digest, Snapshot.get_codec(), compressor.compress(data) + compressor.flush(),
+                                  len(data), time.time(), self.SNAPSHOT_RETENTION)
+        if new or updated:
+            text = "".join(f"\nNew: {url}" for url in new) + "".join(f"\nUpdated: {url}" for url in updated)
+            self.notify_change(monitor.get_url(), monitor.get_digest(), result.get_digest(), text[1:self.DIFF_MAX_CHARS + 1])
+        if pending:
+            # Some pages are still to be fetched: the next check must compare the entries again, even if the feed is unchanged
+            monitor.set_digest(digest, result.get_length())
+            monitor.set_validators(None, None)
+        else:
+            monitor.set_digest(result.get_digest(), result.get_length())
+        return bool(new or updated), pages
+
+    async def add_monitoring_task(self, update: Update, context: ContextTypes.DEFAULT_TYPE, kind=None) -> None:
         try:
             # Retrieve the URL from user data stored in context.
             url: str = context.user_data.get("URL")
-            if not self.get_db().check_link_exists(update.message.from_user.id, url):
-                curr_task: asyncio.Task = asyncio.create_task(self.track_url_changes(update, url))
-                logging.info(curr_task)
-                logging.info(curr_task.get_name())
-                # Insert new link into database along with task name.
-                self.get_db().insert_link(update.message.from_user.id, url, curr_task.get_name())
+            uid = update.message.from_user.id
+            if not self.get_registry().is_subscribed(uid, url):
+                if not self.get_quota().admits(self.get_registry().get_usage(uid), self.get_registry().get_cost_share(url, self.TIME)):
+                    await update.message.reply_text("This URL does not fit in your fetch budget. Use /list to see your usage, "
+                                                    "or /unfollow URLs to free some of it.")
+                    return
+                if self.get_registry().get_monitor(url) is None:
+                    # The URL is not monitored yet: create its monitor and schedule the first check right away.
+                    monitor = Monitor(url, self.TIME, kind=kind)
+                    self.get_registry().add_monitor(monitor)
+                    self.schedule_monitor(monitor)
+                    logging.info(f"{monitor.get_task_name()} scheduled for {url}")
+                    # Insert new monitor into database along with task name.
+                    await self.get_db().insert_monitor(url, monitor.get_task_name(), kind)
+                # Subscribe the user to the monitor of the URL.
+                self.get_registry().subscribe(uid, url)
+                await self.get_db().insert_link(uid, url)
                 await update.message.reply_text("URL added successfully!")
             else:
                 await update.message.reply_text("This URL has already been added.")
@@ -104,16 +487,80 @@ class WebMonitoringBot:
             logging.error(f"Error in start_task: {e}")
 
 
+    # Follow many URLs at once: the URLs are validated off the event loop, checked against the subscriptions of the user in memory,
+    # saved in a single transaction, and their first checks are spread over FOLLOW_SPREAD seconds
+    async def add_monitoring_tasks(self, update: Update, urls: list[str]) -> None:
+        uid = update.message.from_user.id
+        # Normalize the URLs and drop the duplicates, keeping their order.
+        urls = list(dict.fromkeys(self.get_utility().normalize_url(url) for url in urls))
+        valid = await asyncio.to_thread(lambda: [url for url in urls if validators.url(url)])
+        new = [url for url in valid if not self.get_registry().is_subscribed(uid, url)]
+        remaining = max(self.MAX_TASKS_PER_USER - self.get_registry().count_links(uid), 0)
+        # Admit the URLs in order while the estimated usage of the user stays within their fetch budget
+        usage = self.get_registry().get_usage(uid)
+        accepted = []
+        for url in new[:remaining]:
+            cost = self.get_registry().get_cost_share(url, self.TIME)
+            if not self.get_quota().admits(usage, cost):
+                break
+            usage = tuple(used + extra for used, extra in zip(usage, cost))
+            accepted.append(url)
+        monitors = []
+        for url in accepted:
+            if self.get_registry().get_monitor(url) is None:
+                monitor = Monitor(url, self.TIME)
+                self.get_registry().add_monitor(monitor)
+                monitors.append(monitor)
+            self.get_registry().subscribe(uid, url)
+        writes = []
+        for i, monitor in enumerate(monitors):
+            self.schedule_monitor(monitor, i * self.FOLLOW_SPREAD / len(monitors))
+            writes.append(("insert_monitor", (monitor.get_url(), monitor.get_task_name())))
+        writes.extend(("insert_link", (uid, url)) for url in accepted)
+        await self.get_db().run_batch(writes)
+        logging.info(f"{len(accepted)} URLs followed at once by user {uid}, {len(monitors)} of them newly monitored.")
+        text = f"{len(accepted)} URLs added successfully!"
+        if len(valid) > len(new):
+            text += f"\n{len(valid) - len(new)} already followed."
+        if len(urls) > len(valid):
+            text += f"\n{len(urls) - len(valid)} invalid."
+        if len(new) > len(accepted):
+            text += f"\n{len(new) - len(accepted)} not added: you have reached your fetch budget or the maximum number of URLs being tracked (see /list)."
+        await update.message.reply_text(text)
+
+    # Follow a sitemap or an RSS/Atom feed given with /feed <URL>: each check fetches the feed and only the pages it lists as new or changed
+    async def follow_feed(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        uid = update.message.from_user.id
+        if not await self.get_command_handler().is_registered(uid):
+            await self.get_command_handler().start_command(update, context)
+        if self.get_registry().count_links(uid) >= self.MAX_TASKS_PER_USER:
+            await update.message.reply_text("You have reached the maximum number of URLs being tracked.")
+            return
+        if len(context.args) != 1:
+            await update.message.reply_text("Please use /feed <URL> with the URL of a sitemap.xml or of an RSS or Atom feed.")
+            return
+        # Feeds are often selected by their query (?feed=rss2, ?format=rss), so it is part of their URL
+        url: str = self.get_utility().normalize_url(context.args[0], keep_query=True)
+        if not await self.get_utility().validate_url(update, url):
+            await update.message.reply_text("The provided URL is invalid. Please try again.")
+            return
+        context.user_data["URL"] = url
+        await self.add_monitoring_task(update, context, Monitor.FEED)
+
     async def state_request_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        url: str = update.message.text.replace("/follow", "").replace(" ", "")
+        urls: list[str] = update.message.text.replace("/follow", "").split()
+        if len(urls) > 1:
+            # Many URLs have been pasted at once.
+            await self.add_monitoring_tasks(update, urls)
+            return ConversationHandler.END
+        url: str = "".join(urls)
         if len(url) <= 0:
             await update.message.reply_text("The provided URL is empty. Please enter a valid URL:")
             # Return to this state to wait for a valid URL input.
             return self.get_state_request_url()
         else:
             # Normalize URL by removing trailing slashes and ensuring proper format.
-            url: str = urljoin(url, urlparse(url).path)
-            url: str = url[:-1] if url.endswith("/") else url
+            url: str = self.get_utility().normalize_url(url)
             if await self.get_utility().validate_url(update, url):
                 # Save valid URL into user data context.
                 context.user_data["URL"] = url
@@ -125,6 +572,24 @@ class WebMonitoringBot:
                 return self.get_state_request_url()
 
 
+    # Follow the URLs of a CSV or OPML file sent by the user
+    async def state_request_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        document = update.message.document
+        if document.file_size is not None and document.file_size > self.MAX_IMPORT_SIZE:
+            await update.message.reply_text(f"The file is too large, the maximum size is {self.MAX_IMPORT_SIZE // 1024} KB.")
+            return self.get_state_request_url()
+        try:
+            data = await (await document.get_file()).download_as_bytearray()
+            urls = self.get_utility().parse_subscriptions(bytes(data))
+        except Exception as e:
+            logging.error(f"Error importing {document.file_name}: {e}")
+            urls = []
+        if not urls:
+            await update.message.reply_text("No URL found in the file. Please send a CSV or OPML file, or use /cancel.")
+            return self.get_state_request_url()
+        await self.add_monitoring_tasks(update, urls)
+        return ConversationHandler.END
+
     def setup_handlers(self, app):
         conv_handler = (
             ConversationHandler(
@@ -132,6 +597,7 @@ class WebMonitoringBot:
                 states={
                         self.get_state_request_url(): [
                             MessageHandler(filters.TEXT & ~filters.COMMAND, self.state_request_url),
+                            MessageHandler(filters.Document.ALL, self.state_request_file),
                             CommandHandler("cancel", self.get_command_handler().cancel_command), ], },
                 fallbacks=[CommandHandler("start", self.get_command_handler().start_command)],
             )
@@ -141,16 +607,34 @@ class WebMonitoringBot:
         app.add_handler(CommandHandler("stop", self.get_command_handler().stop_command, filters=filters.User(self.get_allowed_ids())))
         app.add_handler(CommandHandler("unfollow", self.get_command_handler().unfollow_command, filters=filters.User(self.get_allowed_ids())))
         app.add_handler(CallbackQueryHandler(self.get_command_handler().unfollow_callback))
+        app.add_handler(CommandHandler("interval", self.get_command_handler().interval_command, filters=filters.User(self.get_allowed_ids())))
+        app.add_handler(CommandHandler("stats", self.get_command_handler().stats_command, filters=filters.User(self.get_admin_ids())))
+        app.add_handler(CommandHandler("workers", self.get_command_handler().workers_command, filters=filters.User(self.get_admin_ids())))
         app.add_handler(CommandHandler("list", self.get_command_handler().show_list_command, filters=filters.User(self.get_allowed_ids())))
+        app.add_handler(CommandHandler("feed", self.follow_feed, filters=filters.User(self.get_allowed_ids())))
+        app.add_handler(CommandHandler("filter", self.get_command_handler().filter_command, filters=filters.User(self.get_allowed_ids())))
+        app.add_handler(CommandHandler("export", self.get_command_handler().export_command, filters=filters.User(self.get_allowed_ids())))
         app.add_handler(CommandHandler("help", self.get_command_handler().show_help_command, filters=filters.User(self.get_allowed_ids())))
 
 
     def main(self) -> None:
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
-        app = Application.builder().token(self._TOKEN_API).build()
+        # Updates are handled concurrently, so that a slow command does not delay the commands of other users
+        builder = Application.builder().token(self._TOKEN_API).concurrent_updates(ChatUpdateProcessor(self.CONCURRENT_UPDATES))
+        if self._TELEGRAM_BASE_URL:
+            # Send the requests to another Bot API server, such as a local one used for testing
+            builder = builder.base_url(f"{self._TELEGRAM_BASE_URL}/bot").base_file_url(f"{self._TELEGRAM_BASE_URL}/file/bot")
+        app = builder.post_init(self.post_init).post_shutdown(self.post_shutdown).build()
         self.setup_handlers(app)
-        app.run_polling()
+        if self._WEBHOOK_URL:
+            # Telegram pushes the updates to the local listener, which rejects requests without the secret token
+            logging.info(f"Listening for updates on {self._WEBHOOK_LISTEN}:{self._WEBHOOK_PORT}.")
+            app.run_webhook(listen=self._WEBHOOK_LISTEN, port=self._WEBHOOK_PORT, url_path=urlparse(self._WEBHOOK_URL).path.lstrip("/"),
+                            cert=self._WEBHOOK_CERT, key=self._WEBHOOK_KEY, webhook_url=self._WEBHOOK_URL, secret_token=self._WEBHOOK_SECRET,
+                            max_connections=self.WEBHOOK_MAX_CONNECTIONS)
+        else:
+            app.run_polling()
 
 
 if __name__ == "__main__":
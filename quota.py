@@ -0,0 +1,50 @@
+import time
+
+
+class Quota:
+    # Initialize the hourly fetch budget of each user: requests sent, bytes received and CPU seconds spent normalizing bodies,
+    # the cost of every URL being shared by its subscribers
+    # Users over budget have their minimum polling interval stretched by a throttle, recomputed every refresh_interval seconds
+    # and never above max_throttle
+    def __init__(self, requests_per_hour, bytes_per_hour, cpu_per_hour, refresh_interval, max_throttle):
+        self._budget = (requests_per_hour, bytes_per_hour, cpu_per_hour)
+        self._refresh_interval = refresh_interval
+        self._max_throttle = max_throttle
+        self._throttles = {}  # Map of user ID to the factor applied to the minimum polling interval of a user over budget
+        self._refreshed = None  # Monotonic time of the last computation of the throttles
+
+    def get_budget(self):
+        return self._budget
+
+    def get_refresh_interval(self):
+        return self._refresh_interval
+
+    def get_max_throttle(self):
+        return self._max_throttle
+
+    # Method to compute the share of the budget used, the largest one among requests, bytes and CPU
+    def get_load(self, usage) -> float:
+        return max(used / budget for used, budget in zip(usage, self.get_budget()))
+
+    # Method to check whether a user with the given usage can take on the given extra cost
+    def admits(self, usage, cost) -> bool:
+        return self.get_load([used + extra for used, extra in zip(usage, cost)]) <= 1.0
+
+    # Method to retrieve the throttles of the users over budget, recomputed from the registry at most every refresh_interval seconds
+    # Each throttle is multiplied by the current load: it grows while the user stays over budget, holds once the usage fits,
+    # and goes away once the user is back under budget
+    def get_throttles(self, registry) -> dict:
+        now = time.monotonic()
+        if self._refreshed is None or now - self._refreshed >= self.get_refresh_interval():
+            self._refreshed = now
+            throttles = {}
+            for uid in registry.get_users():
+                throttle = min(self._throttles.get(uid, 1.0) * self.get_load(registry.get_usage(uid)), self.get_max_throttle())
+                if throttle > 1.0:
+                    throttles[uid] = throttle
+            self._throttles = throttles
+        return self._throttles
+
+    # Method to retrieve the throttle of a user, 1 if the user is within budget
+    def get_throttle(self, uid) -> float:
+        return self._throttles.get(uid, 1.0)
@@ -0,0 +1,122 @@
+from monitor import Monitor
+
+
+class MonitorRegistry:
+    # Initialize the in-process index of monitors and subscriptions, giving O(1) lookups by user and by URL
+    def __init__(self):
+        self._monitors = {}  # Map of URL to its Monitor
+        self._links = {}  # Map of user ID to the set of URLs they follow
+        self._subscribers = {}  # Map of URL to the set of user IDs following it
+        self._bounds = {}  # Map of user ID to the (minimum, maximum) polling interval they chose
+
+    # Method to register the monitor of a URL
+    def add_monitor(self, monitor):
+        self._monitors[monitor.get_url()] = monitor
+        self._subscribers.setdefault(monitor.get_url(), set())
+
+    # Method to retrieve the monitor of a URL, or None if the URL is not monitored
+    def get_monitor(self, url):
+        return self._monitors.get(url)
+
+    # Method to return every registered monitor
+    def get_monitors(self) -> list:
+        return list(self._monitors.values())
+
+    # Method to subscribe a user to the monitor of a URL, which must already be registered
+    def subscribe(self, uid, url):
+        self._links.setdefault(uid, set()).add(url)
+        self._subscribers[url].add(uid)
+
+    # Method to check whether a user follows a URL
+    def is_subscribed(self, uid, url) -> bool:
+        return url in self._links.get(uid, ())
+
+    # Method to retrieve the URLs followed by a user, sorted like the subscriptions in the database
+    def get_links(self, uid) -> list:
+        return sorted(self._links.get(uid, ()))
+
+    # Method to count the URLs followed by a user
+    def count_links(self, uid) -> int:
+        return len(self._links.get(uid, ()))
+
+    # Method to retrieve the IDs of the users following at least one URL
+    def get_users(self) -> list:
+        return list(self._links)
+
+    # Method to estimate the hourly cost of the URLs followed by a user, as (requests, bytes, CPU seconds):
+    # the cost of each URL is shared equally by its subscribers
+    def get_usage(self, uid) -> tuple:
+        usage = [0.0, 0.0, 0.0]
+        for url in self._links.get(uid, ()):
+            share = len(self._subscribers[url])
+            for i, cost in enumerate(self._monitors[url].get_hourly_cost()):
+                usage[i] += cost / share
+        return tuple(usage)
+
+    # Method to estimate the hourly cost of a URL for a user who does not follow it yet, sharing it with its current subscribers
+    # A URL that is not monitored yet costs the requests of its first hour from the given initial interval,
+    # its size is only known after its first check
+    def get_cost_share(self, url, interval) -> tuple:
+        monitor = self._monitors.get(url)
+        if monitor is None:
+            return Monitor.estimate_first_hour(interval), 0.0, 0.0
+        share = len(self._subscribers[url]) + 1
+        return tuple(cost / share for cost in monitor.get_hourly_cost())
+
+    # Method to retrieve the IDs of the users following a URL
+    def get_subscribers(self, url) -> list:
+        return list(self._subscribers.get(url, ()))
+
+    # Method to unsubscribe a user from a URL, returning the monitor of the URL if nobody follows it anymore
+    def unsubscribe(self, uid, url):
+        urls = self._links.get(uid)
+        if urls is None or url not in urls:
+            return None
+        urls.discard(url)
+        if not urls:
+            del self._links[uid]
+        subscribers = self._subscribers[url]
+        subscribers.discard(uid)
+        if subscribers:
+            return None
+        # The last subscriber has left: the monitor is unregistered and handed back to be stopped
+        del self._subscribers[url]
+        return self._monitors.pop(url)
+
+    # Method to set the polling interval bounds chosen by a user, None meaning no preference
+    def set_user_bounds(self, uid, min_interval, max_interval):
+        if min_interval is None and max_interval is None:
+            self._bounds.pop(uid, None)
+        else:
+            self._bounds[uid] = (min_interval, max_interval)
+
+    # Method to retrieve the polling interval bounds chosen by a user
+    def get_user_bounds(self, uid) -> tuple:
+        return self._bounds.get(uid, (None, None))
+
+    # Method to compute the polling interval bounds of a URL within the given global bounds:
+    # the most demanding subscriber decides, so every subscriber gets at least the freshness they asked for
+    # The minimum interval of a user over budget is multiplied by their throttle, so a URL is polled less often
+    # only when all of its subscribers are over budget
+    def get_bounds(self, url, min_interval, max_interval, throttles=None) -> tuple:
+        throttles = throttles or {}
+        mins = []
+        maxs = []
+        for uid in self._subscribers.get(url, ()):
+            user_min, user_max = self._bounds.get(uid, (None, None))
+            user_min = min_interval if user_min is None else max(user_min, min_interval)
+            mins.append(min(user_min * throttles.get(uid, 1.0), max_interval))
+            maxs.append(max_interval if user_max is None else min(user_max, max_interval))
+        lower = min(mins, default=min_interval)
+        upper = min(maxs, default=max_interval)
+        return lower, max(upper, lower)
+
+    # Method to unsubscribe a user from every URL, returning the monitors that nobody follows anymore
+    def unsubscribe_all(self, uid) -> list:
+        self._bounds.pop(uid, None)
+        orphans = []
+        for url in self.get_links(uid):
+            monitor = self.unsubscribe(uid, url)
+            if monitor is not None:
+                orphans.append(monitor)
+        return orphans
@@ -0,0 +1,182 @@
+import itertools
+import logging
+import asyncio
+import random
+import heapq
+import time
+
+
+class Job:
+    # Initialize a scheduled job with its name and the coroutine function to run when it is due
+    def __init__(self, name, callback):
+        self._name = name
+        self._callback = callback
+        self._seq = None  # Sequence number of the heap entry currently valid for this job
+        self._due = 0.0  # Monotonic time at which the job is due
+        self._running = None  # Task of the run in progress, if any
+
+    def get_name(self):
+        return self._name
+
+    def get_callback(self):
+        return self._callback
+
+    def get_seq(self):
+        return self._seq
+
+    def get_due(self):
+        return self._due
+
+    def get_running(self):
+        return self._running
+
+
+class Scheduler:
+    # Initialize the scheduler with the default interval, the size of the fetch worker pool and the jitter ratio
+    def __init__(self, interval, workers, jitter, metrics):
+        self._metrics = metrics
+        self._interval = interval
+        self._workers = workers
+        self._jitter = jitter
+        self._heap = []  # Heap of (due, seq, name) entries, stale entries are skipped lazily
+        self._jobs = {}  # Map of job name to Job
+        self._seq = itertools.count()
+        self._names = itertools.count(1)
+        self._queue = None
+        self._wakeup = None
+        self._tasks = []
+
+    def get_interval(self):
+        return self._interval
+
+    def get_workers(self):
+        return self._workers
+
+    def get_jitter(self):
+        return self._jitter
+
+    def get_metrics(self):
+        return self._metrics
+
+    # Method to start the dispatcher and the pool of fetch workers on the running event loop
+    def start(self):
+        # The queue is bounded so that the dispatcher waits while every worker is busy
+        self._queue = asyncio.Queue(maxsize=self.get_workers())
+        self._wakeup = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._dispatch(), name="Scheduler-dispatcher"))
+        for i in range(self.get_workers()):
+            self._tasks.append(asyncio.create_task(self._work(), name=f"Scheduler-worker-{i + 1}"))
+        logging.info(f"Scheduler started with {self.get_workers()} workers.")
+
+    # Method to stop the dispatcher and the workers, waiting for them to terminate
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        logging.info("Scheduler stopped.")
+
+    # Method to add a new job, returning its name; the first run happens after the given delay
+    def add(self, callback, delay=0.0) -> str:
+        name = f"Job-{next(self._names)}"
+        job = Job(name, callback)
+        self._jobs[name] = job
+        self._push(job, delay)
+        return name
+
+    # Method to remove a job by name, returning True if the job existed
+    # A run in progress is cancelled and awaited, so no check of the job is running once this returns
+    async def remove(self, name) -> bool:
+        # The heap entry is left in place and discarded by the dispatcher when it surfaces
+        job = self._jobs.pop(name, None)
+        if job is None:
+            return False
+        running = job.get_running()
+        if running is not None:
+            running.cancel()
+            await asyncio.gather(running, return_exceptions=True)
+        return True
+
+    # Method to check whether a job with the given name is scheduled
+    def contains(self, name) -> bool:
+        return name in self._jobs
+
+    # Method to return the number of seconds before the next run of a job, or None if the job is not scheduled
+    def get_delay(self, name):
+        job = self._jobs.get(name)
+        if job is None:
+            return None
+        return max(job.get_due() - time.monotonic(), 0.0)
+
+    # Method to return the number of scheduled jobs
+    def count(self) -> int:
+        return len(self._jobs)
+
+    # Private method to compute the delay before the next run, spreading jobs by a random jitter
+    def _next_delay(self, interval):
+        return interval * (1 + random.uniform(-self.get_jitter(), self.get_jitter()))
+
+    # Private method to (re)insert a job in the heap after the given delay
+    def _push(self, job, delay):
+        job._seq = next(self._seq)
+        job._due = time.monotonic() + max(delay, 0.0)
+        heapq.heappush(self._heap, (job._due, job._seq, job.get_name()))
+        # Wake up the dispatcher in case the new entry is due earlier than the one it is waiting for
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # Private method that hands due jobs over to the workers in due-time order
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            due, seq, name = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                # Unlike wait_for, wait never swallows a cancellation arriving as the wakeup is set, which would leave stop()
+                # waiting for a dispatcher blocked on a queue without workers
+                wakeup = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait([wakeup], timeout=delay)
+                finally:
+                    wakeup.cancel()
+                continue
+            heapq.heappop(self._heap)
+            job = self._jobs.get(name)
+            if job is None or job.get_seq() != seq:
+                # Skip entries of removed or rescheduled jobs
+                continue
+            await self._queue.put(job)
+
+    # Private method run by each worker: execute due jobs and schedule their next run
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            run = None
+            try:
+                if self.contains(job.get_name()):
+                    # Record how late the run starts compared to its due time
+                    self.get_metrics().get_scheduler_lag().observe(max(time.monotonic() - job.get_due(), 0.0))
+                    # Each run is a task named after the job, so that removing the job can cancel it
+                    run = asyncio.create_task(job.get_callback()(), name=job.get_name())
+                    job._running = run
+                    await asyncio.wait([run])
+            except asyncio.CancelledError:
+                # The worker is being stopped: stop the run in progress too and wait for it to terminate
+                if run is not None:
+                    run.cancel()
+                    await asyncio.gather(run, return_exceptions=True)
+                raise
+            finally:
+                job._running = None
+                self._queue.task_done()
+            if run is None or run.cancelled():
+                continue
+            if run.exception() is not None:
+                logging.error(f"Error in {job.get_name()}: {run.exception()}")
+            if self._jobs.get(job.get_name()) is job:
+                # A job may return its own interval, otherwise the default one is used
+                interval = run.result() if run.exception() is None else None
+                self._push(job, self._next_delay(interval or self.get_interval()))
@@ -0,0 +1,487 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from monitor import Monitor
+import multiprocessing
+import itertools
+import functools
+import hashlib
+import logging
+import asyncio
+import signal
+import bisect
+import time
+
+
+class HashRing:
+    # Initialize an empty consistent hash ring, each node is placed at replicas points so that keys spread evenly
+    def __init__(self, replicas):
+        self._replicas = replicas
+        self._points = []  # Sorted hashes of the points of every node
+        self._nodes = {}  # Map of point hash to node
+
+    def get_replicas(self):
+        return self._replicas
+
+    # Private method to hash a key to a point of the ring
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    # Method to add a node, which takes over only the keys falling just before its points
+    def add(self, node):
+        for i in range(self.get_replicas()):
+            point = self._hash(f"{node}-{i}")
+            self._nodes[point] = node
+            bisect.insort(self._points, point)
+
+    # Method to remove a node, whose keys move to the nodes following its points
+    def remove(self, node):
+        for i in range(self.get_replicas()):
+            point = self._hash(f"{node}-{i}")
+            if self._nodes.pop(point, None) is not None:
+                self._points.remove(point)
+
+    # Method to return the node owning a key: the node of the first point following the hash of the key
+    def get(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[i]]
+
+
+class Shard:
+    # Initialize the handle of a fetch worker process: commands are sent on one pipe and events received on another
+    def __init__(self, index, process, commands, events):
+        self._index = index
+        self._process = process
+        self._commands = commands
+        self._events = events
+        # Events are received on a dedicated thread, so that waiting for them does not block the event loop, and commands
+        # are written in order on another one, so that a pipe full while the worker is busy does not block it either
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"Shard-{index}")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"Shard-{index}-writer")
+        self._reader = None
+        self._stopping = False  # True once the worker has been asked to stop
+        self._started = time.monotonic()
+
+    def get_index(self):
+        return self._index
+
+    def get_process(self):
+        return self._process
+
+    def get_reader(self):
+        return self._reader
+
+    def is_stopping(self):
+        return self._stopping
+
+    # Method to return the time (in seconds) since the worker was started
+    def get_uptime(self) -> float:
+        return time.monotonic() - self._started
+
+    # Method to send a command to the worker, returning the future of its write
+    def send(self, *message) -> Future:
+        return self._writer.submit(self._write, message)
+
+    # Private method writing a command on the writer thread
+    def _write(self, message):
+        try:
+            self._commands.send(message)
+        except Exception as e:
+            # A worker that exited cannot receive anything, which its reader reports
+            if self._process.is_alive() and not self.is_stopping():
+                logging.error(f"Error sending the {message[0]} command to {self._process.name}: {e}")
+            raise
+
+    # Method to wait for the next event sent by the worker
+    async def receive(self):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._events.recv)
+
+    # Method to release the pipes once the worker has exited
+    def close(self):
+        self._writer.shutdown(wait=False)
+        self._commands.close()
+        self._events.close()
+        self._executor.shutdown(wait=False)
+
+
+class ShardPool:
+    # Delay (in seconds) before restarting a worker that exited unexpectedly, doubled after each consecutive crash,
+    # number of consecutive crashes after which it is not restarted anymore, and time (in seconds) after which a worker
+    # running without crashing has its crashes forgotten
+    RESTART_BASE_DELAY = 1
+    RESTART_MAX_CRASHES = 5
+    RESTART_RESET_TIME = 300
+
+    # Initialize the pool of fetch worker processes: the URLs are assigned to the workers by consistent hashing,
+    # and each worker checks its URLs with its own scheduler, HTTP client and database connection.
+    # bounds(url) returns the polling interval bounds of a URL, on_change(url, prev_digest, curr_digest, diff)
+    # is called in this process for every change detected by a worker, and on_usage(url, interval, fetch_bytes, fetch_cpu)
+    # for every URL after each synchronization, with the polling interval and average cost of a check measured by its worker,
+    # and on_metrics(drained) for the metrics recorded by each worker since they were last collected.
+    # The coroutine function restore(urls) returns the saved (state, delay) of the monitors of the given URLs, handed over
+    # to a worker restarted after exiting unexpectedly
+    def __init__(self, processes, replicas, sync_interval, bot_class, database, bounds, on_change, on_usage, on_metrics, restore):
+        self._processes = processes
+        self._sync_interval = sync_interval
+        self._bot_class = bot_class
+        self._database = database
+        self._bounds = bounds
+        self._on_change = on_change
+        self._on_usage = on_usage
+        self._on_metrics = on_metrics
+        self._restore = restore
+        self._ring = HashRing(replicas)
+        self._shards = []  # Shards indexed by their position in the ring
+        self._jobs = {}  # Map of job name to the (URL, shard index) pair
+        self._names = itertools.count(1)
+        self._requests = itertools.count()
+        self._waiting = {}  # Map of request ID to the (shard index, future) waiting for the reply of a worker
+        self._crashes = {}  # Map of shard index to the number of consecutive unexpected exits of its worker
+        self._sync_task = None
+
+    def get_processes(self):
+        return self._processes
+
+    def get_sync_interval(self):
+        return self._sync_interval
+
+    # Method to start the worker processes and the periodic synchronization of the polling interval bounds
+    async def start(self):
+        for index in range(self.get_processes()):
+            self._spawn(index)
+        self._sync_task = asyncio.create_task(self._sync_periodically(), name="ShardPool-sync")
+        logging.info(f"{self.get_processes()} fetch worker processes started.")
+
+    # Method to stop the worker processes, which commit their pending writes before exiting
+    async def stop(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+        await asyncio.gather(*[self._stop_shard(shard) for shard in self._shards])
+        self._shards.clear()
+        logging.info("Fetch worker processes stopped.")
+
+    # Method to hand a monitor over to the worker owning its URL, returning the name of its job
+    def add(self, monitor: Monitor, delay=0.0) -> str:
+        name = f"Job-{next(self._names)}"
+        index = self._ring.get(monitor.get_url())
+        self._jobs[name] = (monitor.get_url(), index)
+        self._shards[index].send("add", name, monitor.get_state(), delay, self._bounds(monitor.get_url()))
+        return name
+
+    # Method to remove a job by name, returning True if the job existed
+    # Like Scheduler.remove, no check of the job is running in its worker once this returns
+    async def remove(self, name) -> bool:
+        entry = self._jobs.pop(name, None)
+        if entry is None:
+            return False
+        await self._request(entry[1], "remove", name)
+        return True
+
+    # Method to change the extraction pipeline of the monitor of a job in its worker
+    def configure(self, name, selector, masks):
+        entry = self._jobs.get(name)
+        if entry is not None:
+            self._shards[entry[1]].send("configure", name, selector, masks)
+
+    # Method to return the number of jobs
+    def count(self) -> int:
+        return len(self._jobs)
+
+    # Method to return the process IDs of the workers
+    def get_worker_pids(self) -> list:
+        return [shard.get_process().pid for shard in self._shards]
+
+    # Method to return the number of jobs of each worker
+    def get_shard_counts(self) -> list:
+        counts = [0] * len(self._shards)
+        for _, index in self._jobs.values():
+            counts[index] += 1
+        return counts
+
+    # Method to change the number of workers, moving only the URLs whose owner changed on the ring
+    # Each moved monitor is handed over with its state and the time left before its next check; returns the number of moved jobs
+    async def resize(self, processes) -> int:
+        # The workers given up after crashing too often are started again
+        for shard in self._shards[:processes]:
+            if self._crashes.get(shard.get_index(), 0) > self.RESTART_MAX_CRASHES:
+                await self._stop_shard(shard)
+                self._shards[shard.get_index()] = self._start_process(shard.get_index())
+                self._ring.add(shard.get_index())
+                del self._crashes[shard.get_index()]
+                await self._hand_over(shard.get_index())
+        for index in range(len(self._shards), processes):
+            self._spawn(index)
+        removed = self._shards[processes:]
+        for shard in removed:
+            self._ring.remove(shard.get_index())
+        moves = [self._move(name, url, index) for name, (url, index) in self._jobs.items() if self._ring.get(url) != index]
+        await asyncio.gather(*moves)
+        await asyncio.gather(*[self._stop_shard(shard) for shard in removed])
+        del self._shards[processes:]
+        self._processes = processes
+        logging.info(f"{len(moves)} of {len(self._jobs)} monitors moved to {processes} fetch worker processes.")
+        return len(moves)
+
+    # Method to send the current polling interval bounds of its URLs to every worker, which replies with the usage of its URLs
+    def sync_bounds(self):
+        bounds = [{} for _ in self._shards]
+        for url, index in self._jobs.values():
+            bounds[index][url] = self._bounds(url)
+        for shard, shard_bounds in zip(self._shards, bounds):
+            shard.send("bounds", shard_bounds)
+
+    # Method to collect the metrics recorded by every worker since the last collection
+    async def collect_metrics(self):
+        replies = await asyncio.gather(*[self._request(shard.get_index(), "metrics") for shard in self._shards])
+        for reply in replies:
+            if reply[0] is not None:
+                self._on_metrics(reply[0])
+
+    # Private method to start a worker process at a new index of the ring
+    def _spawn(self, index):
+        self._shards.append(self._start_process(index))
+        self._ring.add(index)
+
+    # Private method to start the worker process of the given index, returning its shard
+    def _start_process(self, index) -> Shard:
+        context = multiprocessing.get_context("spawn")
+        commands_reader, commands_writer = context.Pipe(duplex=False)
+        events_reader, events_writer = context.Pipe(duplex=False)
+        process = context.Process(target=run_worker, args=(commands_reader, events_writer, self._bot_class, self._database),
+                                  name=f"Fetch-worker-{index + 1}", daemon=True)
+        process.start()
+        # Close the ends used by the worker, so that its exit is seen as the end of the events pipe
+        commands_reader.close()
+        events_writer.close()
+        shard = Shard(index, process, commands_writer, events_reader)
+        shard._reader = asyncio.create_task(self._receive(shard), name=f"ShardPool-reader-{index + 1}")
+        return shard
+
+    # Private method to replace a worker that exited unexpectedly, handing its monitors over to the new worker
+    # The monitors resume from the state last saved in the database, so the checks the worker did not commit are run again.
+    # The restart is delayed more after each consecutive crash, and given up after RESTART_MAX_CRASHES of them
+    async def _restart(self, shard: Shard):
+        index = shard.get_index()
+        name = shard.get_process().name
+        await asyncio.to_thread(shard.get_process().join, 1)
+        crashes = 1 if shard.get_uptime() >= self.RESTART_RESET_TIME else self._crashes.get(index, 0) + 1
+        self._crashes[index] = crashes
+        if crashes > self.RESTART_MAX_CRASHES:
+            # New URLs go to the other workers, the ones of this worker stay unchecked until it is started again by resize
+            self._ring.remove(index)
+            urls = [url for url, owner in self._jobs.values() if owner == index]
+            logging.error(f"{name} exited unexpectedly {crashes} times in a row (exit code {shard.get_process().exitcode}), it is not restarted anymore until /workers is used. "
+                          f"These URLs are not checked anymore: {', '.join(urls)}")
+            return
+        delay = self.RESTART_BASE_DELAY * 2 ** (crashes - 1)
+        logging.error(f"{name} exited unexpectedly (exit code {shard.get_process().exitcode}), restarting it in {delay} seconds.")
+        # Until then, the commands sent to the worker are lost, the jobs added or removed in the meantime are handled below
+        await asyncio.sleep(delay)
+        self._shards[index] = self._start_process(index)
+        shard.close()
+        await self._hand_over(index)
+
+    # Private method to hand the jobs of a restarted worker over to it, with the state last saved in the database
+    async def _hand_over(self, index):
+        name = self._shards[index].get_process().name
+        jobs = {job: url for job, (url, owner) in self._jobs.items() if owner == index}
+        try:
+            states = await self._restore(list(jobs.values()))
+        except Exception as e:
+            logging.error(f"Error restoring the monitors of {name}, its URLs are not checked anymore: {e}")
+            return
+        restored = 0
+        for job, url in jobs.items():
+            # Skip the jobs removed or moved while the states were loaded
+            if self._jobs.get(job) != (url, index) or url not in states:
+                continue
+            state, delay = states[url]
+            self._shards[index].send("add", job, state, delay, self._bounds(url))
+            restored += 1
+        logging.info(f"{restored} monitors handed over to the restarted {name}.")
+
+    # Private method to stop a worker and wait for it to exit
+    async def _stop_shard(self, shard: Shard):
+        if not shard.get_process().is_alive():
+            # The worker exited unexpectedly, its restart is cancelled
+            shard.get_reader().cancel()
+        shard._stopping = True
+        try:
+            shard.send("stop")
+        except RuntimeError:
+            # The writer of the shard is already shut down
+            pass
+        await asyncio.to_thread(shard.get_process().join, 10)
+        if shard.get_process().is_alive():
+            logging.warning(f"{shard.get_process().name} did not stop in time, terminating it.")
+            shard.get_process().terminate()
+        await asyncio.gather(shard.get_reader(), return_exceptions=True)
+        shard.close()
+
+    # Private method to move a job from its worker to the worker now owning its URL
+    async def _move(self, name, url, index):
+        state, delay = await self._request(index, "remove", name)
+        if self._jobs.get(name) != (url, index):
+            # The job has been removed in the meantime
+            return
+        if state is None:
+            # The worker exited before replying, the monitor resumes from its saved state
+            state, delay = (await self._restore([url])).get(url, (None, None))
+            if state is None or self._jobs.get(name) != (url, index):
+                return
+        owner = self._ring.get(url)
+        self._jobs[name] = (url, owner)
+        self._shards[owner].send("add", name, state, delay, self._bounds(url))
+
+    # Private method to send a command to a worker and wait for its reply, (None, None) if the worker exited before replying
+    async def _request(self, index, command, *args):
+        request = next(self._requests)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request] = (index, future)
+        sent = asyncio.wrap_future(self._shards[index].send(command, request, *args))
+        sent.add_done_callback(lambda write: self._release(request) if write.exception() is not None else None)
+        return await future
+
+    # Private method to release a request waiting for the reply of a worker that will never come
+    def _release(self, request):
+        _, future = self._waiting.pop(request, (None, None))
+        if future is not None and not future.done():
+            future.set_result((None, None))
+
+    # Private method receiving the events of a worker until it exits
+    async def _receive(self, shard: Shard):
+        while True:
+            try:
+                event = await shard.receive()
+            except (EOFError, OSError):
+                break
+            if event[0] == "change":
+                try:
+                    self._on_change(*event[1:])
+                except Exception as e:
+                    logging.error(f"Error handling a change from {shard.get_process().name}: {e}")
+            elif event[0] == "usage":
+                for name, usage in event[1].items():
+                    entry = self._jobs.get(name)
+                    if entry is not None:
+                        self._on_usage(entry[0], *usage)
+            elif event[0] == "reply":
+                _, future = self._waiting.pop(event[1], (None, None))
+                if future is not None and not future.done():
+                    future.set_result(event[2:])
+        # Release the requests still waiting for a reply of the worker
+        for request, (index, _) in list(self._waiting.items()):
+            if index == shard.get_index():
+                self._release(request)
+        if not shard.is_stopping():
+            await self._restart(shard)
+
+    # Private method that sends the polling interval bounds to the workers every sync_interval seconds
+    async def _sync_periodically(self):
+        while True:
+            await asyncio.sleep(self.get_sync_interval())
+            self.sync_bounds()
+
+
+class ShardWorker:
+    # Initialize the worker side of a fetch worker process, which checks the URLs handed over by the pool
+    def __init__(self, commands, events):
+        self._commands = commands
+        self._events = events
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Shard-commands")
+        # Events are written in order on a dedicated thread, so that a pipe full while the main process is busy does not block the checks
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Shard-events")
+        self._monitors = {}  # Map of job name in the pool to the monitor checked by this worker
+        self._bounds = {}  # Map of URL to the polling interval bounds sent by the pool
+
+    # Method to return the polling interval bounds of a URL sent by the pool, or the global ones
+    def get_bounds(self, url, min_interval, max_interval) -> tuple:
+        return self._bounds.get(url, (min_interval, max_interval))
+
+    # Method to send a change to the process owning the Telegram connection, which notifies the subscribers
+    def send_change(self, url, prev_digest, curr_digest, diff):
+        self._send("change", url, prev_digest, curr_digest, diff)
+
+    # Private method to send an event to the pool on the writer thread
+    def _send(self, *event):
+        self._writer.submit(self._write, event)
+
+    # Private method writing an event on the writer thread
+    def _write(self, event):
+        try:
+            self._events.send(event)
+        except OSError as e:
+            logging.error(f"Error sending the {event[0]} event to the main process: {e}")
+
+    # Method to run the worker until the pool stops it
+    async def run(self, bot_class, database):
+        bot = bot_class(database, shard=self)
+        bot.get_db().start()
+        bot.get_scheduler().start()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                command = await loop.run_in_executor(self._executor, self._commands.recv)
+                if command[0] == "add":
+                    self._add(bot, *command[1:])
+                elif command[0] == "remove":
+                    await self._remove(bot, *command[1:])
+                elif command[0] == "configure":
+                    self._configure(*command[1:])
+                elif command[0] == "metrics":
+                    self._send("reply", command[1], bot.get_metrics().drain())
+                elif command[0] == "bounds":
+                    self._bounds = command[1]
+                    self._send_usage()
+                elif command[0] == "stop":
+                    break
+        except EOFError:
+            # The main process has exited
+            pass
+        finally:
+            await bot.get_scheduler().stop()
+            await bot.get_fetcher().close()
+            await bot.get_db().close()
+            # The events written last, such as the replies to the pool, are delivered before the pipe is closed
+            await asyncio.to_thread(self._writer.shutdown)
+            self._events.close()
+            self._executor.shutdown(wait=False)
+
+    # Private method to send the polling interval and average cost of a check of every monitor to the pool
+    def _send_usage(self):
+        self._send("usage", {name: (monitor.get_interval(), monitor.get_fetch_bytes(), monitor.get_fetch_cpu())
+                             for name, monitor in self._monitors.items()})
+
+    # Private method to schedule the checks of a monitor handed over by the pool
+    def _add(self, bot, name, state, delay, bounds):
+        monitor = Monitor(*state)
+        self._bounds[monitor.get_url()] = bounds
+        monitor.set_task_name(bot.get_scheduler().add(functools.partial(bot.track_url_changes, monitor), delay))
+        self._monitors[name] = monitor
+
+    # Private method to change the extraction pipeline of a monitor
+    def _configure(self, name, selector, masks):
+        monitor = self._monitors.get(name)
+        if monitor is not None:
+            monitor.set_pipeline(selector, masks)
+
+    # Private method to remove a monitor, replying with its state and the time left before its next check
+    async def _remove(self, bot, request, name):
+        monitor = self._monitors.pop(name, None)
+        if monitor is None:
+            self._send("reply", request, None, None)
+            return
+        delay = bot.get_scheduler().get_delay(monitor.get_task_name())
+        await bot.get_scheduler().remove(monitor.get_task_name())
+        self._bounds.pop(monitor.get_url(), None)
+        self._send("reply", request, monitor.get_state(), delay or 0.0)
+
+
+# Entry point of a fetch worker process
+def run_worker(commands, events, bot_class, database):
+    # The main process handles the shutdown signals and stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(ShardWorker(commands, events).run(bot_class, database))
@@ -0,0 +1,51 @@
+import difflib
+import zlib
+
+try:
+    import zstandard  # zstd is used for snapshots only when the zstandard package is installed
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+
+class Snapshot:
+    ZLIB = "zlib"
+    ZSTD = "zstd"
+
+    # Method to return the codec used to compress new snapshots
+    @staticmethod
+    def get_codec() -> str:
+        return Snapshot.ZSTD if ZSTD_AVAILABLE else Snapshot.ZLIB
+
+    # Method to create a streaming compressor for a body, fed chunk by chunk while it is downloaded
+    @staticmethod
+    def compressor(level):
+        if ZSTD_AVAILABLE:
+            return zstandard.ZstdCompressor(level=level).compressobj()
+        return zlib.compressobj(level)
+
+    # Method to decompress a snapshot stored with the given codec
+    @staticmethod
+    def decompress(codec, data) -> bytes:
+        if codec == Snapshot.ZSTD:
+            if not ZSTD_AVAILABLE:
+                raise ValueError("The zstandard package is required to read zstd snapshots.")
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return zlib.decompress(data)
+
+    # Method to compute a compact unified diff (no context lines) between two bodies, truncated to max_chars
+    @staticmethod
+    def diff(prev_body: bytes, curr_body: bytes, encoding, max_chars) -> str:
+        prev_lines = prev_body.decode(encoding, errors="replace").splitlines()
+        curr_lines = curr_body.decode(encoding, errors="replace").splitlines()
+        text = ""
+        for line in difflib.unified_diff(prev_lines, curr_lines, n=0, lineterm=""):
+            if line.startswith(("---", "+++", "@@")):
+                continue
+            line = line.strip()
+            if len(line) <= 1:
+                continue
+            if len(text) + len(line) + 1 > max_chars:
+                return text + "…"
+            text += line + "\n"
+        return text.rstrip("\n")
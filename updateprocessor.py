@@ -0,0 +1,61 @@
+from telegram.ext import BaseUpdateProcessor
+from telegram import Update
+import asyncio
+import sys
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    # Initialize the processor handling up to max_concurrent_updates updates at once: the updates of a same chat (or user)
+    # are handled one at a time in the order they arrived, as conversations expect, and unrelated updates in parallel
+    # The semaphore of the base class is taken before do_process_update, so it is left unbounded and the limit is enforced
+    # once the turn of an update has come: the updates waiting for their turn do not hold the slots of other chats
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self._limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}  # Map of chat or user ID to the [lock, number of updates holding or waiting for it] of its updates
+
+    def get_limit(self):
+        return self._limit
+
+    # Method to return the number of chats with updates being handled
+    def count(self) -> int:
+        return len(self._locks)
+
+    # Private method to return the key ordering an update: its chat, or its user, or None if it has neither
+    @staticmethod
+    def _get_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    # Method to handle an update once the previous updates of its chat are handled and a slot is free
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._get_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self._locks[key] = entry
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
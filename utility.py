@@ -1,12 +1,18 @@
 from telegram.ext import Application, CommandHandler, filters, ContextTypes, CallbackContext, CallbackQueryHandler, ConversationHandler, MessageHandler
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from httpx import RequestError, HTTPStatusError, AsyncClient, Response
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, urlunparse
 from dotenv import load_dotenv
 from database import Database
+from notifier import Notifier
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
 import validators
 import logging
+import csv
+import io
 import asyncio
+import secrets
 import signal
 import sys
 import os
@@ -21,6 +27,54 @@ class Utility:
             return False
         return True
 
+    @staticmethod
+    def normalize_url(url: str, keep_query: bool = False) -> str:
+        # Drop query and fragment, lowercase scheme and host and strip default ports and trailing slashes,
+        # so that equivalent URLs share a single monitor.
+        # The query is kept when it selects the resource, such as the format of a feed (?feed=rss2).
+        parsed = urlparse(url)
+        scheme = parsed.scheme.lower()
+        netloc = parsed.netloc.lower()
+        if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+            netloc = netloc.rsplit(":", 1)[0]
+        path = parsed.path[:-1] if parsed.path.endswith("/") else parsed.path
+        return urlunparse((scheme, netloc, path, "", parsed.query if keep_query else "", ""))
+
+    @staticmethod
+    def parse_subscriptions(data: bytes) -> list[str]:
+        # Extract the URLs of an OPML file (the xmlUrl, htmlUrl or url attribute of each outline) or of a CSV file (every cell holding a URL).
+        text = data.decode("utf-8-sig", errors="replace")
+        if text.lstrip().startswith("<"):
+            root = ElementTree.fromstring(text)
+            urls = [outline.get("xmlUrl") or outline.get("htmlUrl") or outline.get("url") for outline in root.iter("outline")]
+            return [url.strip() for url in urls if url]
+        return [cell.strip() for row in csv.reader(io.StringIO(text)) for cell in row if cell.strip().lower().startswith(("http://", "https://"))]
+
+    @staticmethod
+    def export_csv(urls: list[str]) -> bytes:
+        # Write the URLs in a CSV file with a header row.
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["url"])
+        writer.writerows([url] for url in urls)
+        return output.getvalue().encode()
+
+    @staticmethod
+    def export_opml(urls: list[str]) -> bytes:
+        # Write the URLs in an OPML file, one outline for each URL.
+        outlines = "".join(f"    <outline type=\"link\" text={quoteattr(url)} url={quoteattr(url)} htmlUrl={quoteattr(url)}/>\n" for url in urls)
+        return (f"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<opml version=\"2.0\">\n  <head><title>PeppyWebMonitorBot subscriptions</title></head>\n"
+                f"  <body>\n{outlines}  </body>\n</opml>\n").encode()
+
+    @staticmethod
+    def format_size(size: float) -> str:
+        # Write a number of bytes with the largest unit keeping it above 1.
+        for unit in ("B", "KB", "MB"):
+            if size < 1024:
+                return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+            size /= 1024
+        return f"{size:.1f} GB"
+
     @staticmethod
     def load_token_api() -> str:
         try:
@@ -41,6 +95,71 @@ class Utility:
             logging.error("Invalid STATE_REQUEST_URL in .env file")
             return -1
 
+    @staticmethod
+    def load_admin_ids() -> list[int]:
+        try:
+            # Retrieve and convert the optional ADMIN_IDS from environment variables to a list of integers
+            return [int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id]
+        except ValueError:
+            # Log an error if ADMIN_IDS is invalid in the .env file
+            logging.error("Invalid ADMIN_IDS in .env file")
+            return []
+
+    @staticmethod
+    def load_metrics_port() -> int:
+        try:
+            # Retrieve the optional METRICS_PORT from environment variables, 0 disables the metrics endpoint
+            return int(os.getenv("METRICS_PORT") or 0)
+        except ValueError:
+            # Log an error if METRICS_PORT is invalid in the .env file
+            logging.error("Invalid METRICS_PORT in .env file")
+            return 0
+
+    @staticmethod
+    def load_fetch_processes() -> int:
+        try:
+            # Retrieve the optional FETCH_PROCESSES from environment variables, 0 or 1 checks every URL in the main process
+            return int(os.getenv("FETCH_PROCESSES") or 0)
+        except ValueError:
+            # Log an error if FETCH_PROCESSES is invalid in the .env file
+            logging.error("Invalid FETCH_PROCESSES in .env file")
+            return 0
+
+    @staticmethod
+    def load_webhook_url() -> str:
+        # Retrieve the optional WEBHOOK_URL from environment variables, the public URL receiving the updates in webhook mode
+        return os.getenv("WEBHOOK_URL") or ""
+
+    @staticmethod
+    def load_webhook_listen() -> str:
+        # Retrieve the optional WEBHOOK_LISTEN from environment variables, the interface of the local webhook listener
+        return os.getenv("WEBHOOK_LISTEN") or "127.0.0.1"
+
+    @staticmethod
+    def load_webhook_port() -> int:
+        try:
+            # Retrieve the optional WEBHOOK_PORT from environment variables, the port of the local webhook listener
+            return int(os.getenv("WEBHOOK_PORT") or 8443)
+        except ValueError:
+            # Log an error if WEBHOOK_PORT is invalid in the .env file
+            logging.error("Invalid WEBHOOK_PORT in .env file")
+            return 8443
+
+    @staticmethod
+    def load_webhook_secret() -> str:
+        # Retrieve the optional WEBHOOK_SECRET from environment variables, or generate one, since it is sent to Telegram on every start
+        return os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+    @staticmethod
+    def load_webhook_certificate() -> tuple:
+        # Retrieve the optional WEBHOOK_CERT and WEBHOOK_KEY file paths from environment variables, which make the listener use HTTPS
+        return os.getenv("WEBHOOK_CERT") or None, os.getenv("WEBHOOK_KEY") or None
+
+    @staticmethod
+    def load_telegram_base_url() -> str:
+        # Retrieve the optional TELEGRAM_BASE_URL from environment variables, used to run the bot against a local Bot API server
+        return os.getenv("TELEGRAM_BASE_URL") or ""
+
     @staticmethod
     def load_allowed_ids() -> list[int]:
         try:
@@ -52,23 +171,10 @@ class Utility:
             return []
 
     @staticmethod
-    async def fetch_url_content(url: str) -> str:
-        try:
-            async with AsyncClient(timeout=10.0) as client:
-                response: Response = await client.get(url)
-                response.raise_for_status()
-                return response.text
-        except HTTPStatusError as e:
-            # Log HTTP errors encountered while fetching URL content.
-            logging.error(f"HTTP error for {url}: {e.response.status_code}")
-            return ""
-        except RequestError as e:
-            # Log request errors encountered while fetching URL content.
-            logging.error(f"Request error for {url}: {e}")
-            return ""
-
-    @staticmethod
-    async def check_for_changes(prev_content: str, curr_content: str, url: str, update: Update):
-        # Check if there are changes between previous and current content.
-        if prev_content and curr_content and prev_content != curr_content:
-            await update.message.reply_text(f"Content changed for {url}.")
+    def check_for_changes(prev_digest: str, curr_digest: str, url: str, notifier: Notifier, subscribers: list[int], diff: str = None):
+        # Check if there are changes between the digests of the previous and current content.
+        if prev_digest and curr_digest and prev_digest != curr_digest:
+            text = f"Content changed for {url}." if not diff else f"Content changed for {url}:\n{diff}"
+            # Queue a notification for every user following the URL, without waiting for its delivery.
+            for uid in subscribers:
+                notifier.notify(uid, text)